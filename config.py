@@ -6,23 +6,27 @@ import os
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения из .env файла
+# (модуль импортируется один раз за процесс, поэтому .env читается тоже один раз)
 load_dotenv()
 
+# Все значения читаются один раз при импорте и дальше используются как константы
+_ENV = os.environ
+
 # Токен бота из переменных окружения
-BOT_TOKEN = os.getenv("BOT_TOKEN")
+BOT_TOKEN = _ENV.get("BOT_TOKEN")
 
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не найден в переменных окружения. Создайте .env файл с BOT_TOKEN=your_token")
 
 # URL для webhook (если используется webhook вместо polling)
 # На Render.com это будет что-то вроде: https://your-bot-name.onrender.com/webhook
-WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_URL = _ENV.get("WEBHOOK_URL")
 
 # Порт для веб-сервера (по умолчанию 8000, Render.com автоматически определяет порт)
 # Обрабатываем случай, когда PORT может быть пустой строкой
-port_str = os.getenv("PORT") or os.getenv("WEBHOOK_PORT") or "8000"
+port_str = _ENV.get("PORT") or _ENV.get("WEBHOOK_PORT") or "8000"
 WEBHOOK_PORT = int(port_str) if port_str.strip() else 8000
 
 # Путь для webhook (по умолчанию /webhook)
-WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_PATH = _ENV.get("WEBHOOK_PATH", "/webhook")
 
@@ -1,251 +1,564 @@
 """
 Модуль для работы с базой данных SQLite.
 Содержит функции для создания таблиц и работы с данными пользователей, программ и результатов.
+Функции синхронные: из обработчиков бота их вызывают через asyncio.to_thread,
+чтобы запросы к SQLite не блокировали event loop.
 """
+import atexit
+import logging
 import sqlite3
 import os
-from datetime import datetime
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import chain, groupby
+from operator import itemgetter
 from typing import List, Dict, Optional, Tuple
 
-# Путь к файлу базы данных
-DB_PATH = "workout_bot.db"
+from utils.sessions import SessionStore
+
+logger = logging.getLogger(__name__)
+
+# Путь к файлу базы данных (переопределяется переменной окружения WORKOUT_BOT_DB).
+# Поддерживаются URI вида "file::memory:?cache=shared" - например, для тестов
+DB_PATH = os.getenv("WORKOUT_BOT_DB", "workout_bot.db")
+
+# Общее соединение на весь процесс: кэш страниц SQLite живет, пока открыто соединение,
+# поэтому не закрываем его после каждого запроса
+_CONN: Optional[sqlite3.Connection] = None
+_LOCK = threading.RLock()
+
+# Версия схемы (PRAGMA user_version): до нее init_db однократно доводит старые базы
+_SCHEMA_VERSION = 3
+
+# Лимит параметров в одном запросе (SQLITE_MAX_VARIABLE_NUMBER в старых сборках SQLite)
+_MAX_SQL_PARAMS = 999
+
+# Кэш чтений по пользователю (доступ под _LOCK). Сбрасывается в функциях,
+# которые меняют соответствующие таблицы: статистика - results, программа - programs
+# (ключ - (program_id, день), у программы без ID program_id = None),
+# список программ - workout_programs, тренировки по кнопкам - button_workouts
+# (строки одной тренировки с подходами - по ее номеру)
+_stats_cache: Dict[int, Dict[str, float]] = {}
+_program_cache: Dict[int, Dict[Tuple[Optional[int], Optional[str]], Dict[str, List[Dict]]]] = {}
+_user_programs_cache: Dict[int, List[Dict]] = {}
+_button_workouts_cache: Dict[int, List[sqlite3.Row]] = {}
+_button_workout_rows_cache: Dict[int, Dict[int, List[tuple]]] = {}
+
+# Последний вес подхода по пользователю: (упражнение, подход) и
+# (тренировка, упражнение, подход) -> вес. Функции сохранения результатов
+# обновляют его сразу, поэтому кэш видит и еще не записанные из буфера строки
+_last_weight_cache: Dict[int, Dict[Tuple[str, int], Optional[float]]] = {}
+_last_button_weight_cache: Dict[int, Dict[Tuple[int, str, int], Optional[float]]] = {}
+
+# Результаты подходов копятся в памяти (доступ под _LOCK) и пишутся одной транзакцией
+# через executemany: по достижении _RESULTS_FLUSH_SIZE строк, в конце тренировки
+# (flush_results) и перед запросами/изменениями, которым нужны все результаты
+_RESULTS_FLUSH_SIZE = 64
+_pending_results: List[tuple] = []
+_pending_button_results: List[tuple] = []
+
+# Распознанные, но еще не сохраненные программы: {user_id: {'program': ..., 'program_name': ...}}.
+# Заполняются обработчиками бота до подтверждения; брошенные удаляются через час
+temp_programs = SessionStore(ttl=60 * 60)
+
+# SQL самых частых запросов: одна и та же строка на каждый вызов,
+# поэтому подготовленный запрос берется из кэша соединения
+_SQL_ADD_USER = "INSERT OR IGNORE INTO users (id, username) VALUES (?, ?)"
+_SQL_SAVE_RESULT = """
+    INSERT INTO results (user_id, exercise_id, day, exercise, set_number, weight, date)
+    VALUES (?, ?, ?, ?, ?, ?, datetime(?, 'unixepoch', 'localtime'))
+"""
+_SQL_GET_LAST_WEIGHT = """
+    SELECT weight FROM results
+    WHERE user_id = ? AND exercise = ? AND set_number = ?
+    ORDER BY id DESC LIMIT 1
+"""
+_SQL_GET_STATS = """
+    SELECT exercise, MAX(weight) as max_weight
+    FROM results
+    WHERE user_id = ?
+    GROUP BY exercise
+    ORDER BY exercise
+"""
+# Результаты переживают перезапись строк programs: ON DELETE CASCADE
+# на results.exercise_id должен срабатывать только при удалении программы
+_SQL_DETACH_RESULTS = "UPDATE results SET exercise_id = NULL WHERE exercise_id = ?"
+_SQL_SAVE_BWR = """
+    INSERT INTO button_workout_results
+    (user_id, workout_number, exercise_name, set_number, weight, date)
+    VALUES (?, ?, ?, ?, ?, datetime(?, 'unixepoch', 'localtime'))
+"""
+_SQL_GET_LAST_BWR_WEIGHT = """
+    SELECT weight FROM button_workout_results
+    WHERE user_id = ? AND workout_number = ? AND exercise_name = ? AND set_number = ?
+    ORDER BY id DESC LIMIT 1
+"""
 
 
 def get_connection():
-    """Создает и возвращает соединение с базой данных."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row  # Для доступа к колонкам по имени
-    return conn
+    """
+    Возвращает общее соединение с базой данных.
+    При первом вызове открывает его и применяет PRAGMA-настройки.
+    """
+    global _CONN
 
+    with _LOCK:
+        if _CONN is None:
+            conn = sqlite3.connect(
+                DB_PATH,
+                check_same_thread=False,
+                cached_statements=256,
+                uri=DB_PATH.startswith("file:")
+            )
+            # Row нужен только там, где колонки читаются по имени; горячие пути
+            # берут курсор без row_factory через _tuple_cursor()
+            conn.row_factory = sqlite3.Row
 
-def init_db():
+            # WAL: читатели не блокируются писателем, один fsync на checkpoint вместо каждого commit
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA cache_size=-64000")  # ~64 МБ кэша страниц
+            conn.execute("PRAGMA mmap_size=134217728")  # 128 МБ memory-mapped I/O
+            # Внешние ключи SQLite проверяет только при явном включении на каждом соединении;
+            # без этого ON DELETE CASCADE в схеме не срабатывает
+            conn.execute("PRAGMA foreign_keys=ON")
+
+            _CONN = conn
+            atexit.register(close_connection)
+        return _CONN
+
+
+def close_connection():
+    """Закрывает общее соединение с базой данных (вызывается при завершении процесса)."""
+    global _CONN
+
+    with _LOCK:
+        if _CONN is not None:
+            with _CONN:
+                _flush_pending(_CONN)
+            # Обновляем статистику планировщика по таблицам, которые заметно изменились
+            _CONN.execute("PRAGMA optimize")
+            _CONN.close()
+            _CONN = None
+
+
+def maintenance():
     """
-    Инициализирует базу данных, создавая необходимые таблицы.
-    Вызывается при первом запуске бота.
+    Периодическое обслуживание базы данных.
+    Обновляет статистику планировщика и переносит WAL в основной файл, не блокируя читателей.
+    """
+    with _locked_connection() as conn:
+        with conn:
+            _flush_pending(conn)
+        conn.execute("PRAGMA optimize")
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+
+@contextmanager
+def _locked_connection():
+    """
+    Выдает общее соединение под блокировкой.
+    При ошибке откатывает незавершенную транзакцию, чтобы она не попала в следующий commit.
+    """
+    with _LOCK:
+        conn = get_connection()
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+
+
+@contextmanager
+def _immediate_transaction():
+    """
+    Выдает общее соединение внутри транзакции BEGIN IMMEDIATE.
+    Блокировка на запись берется сразу, поэтому чтение текущих строк и их перезапись
+    идут по одному снимку. При успехе - commit, при ошибке - rollback.
+    """
+    with _locked_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        with conn:
+            # Отложенные результаты ссылаются на строки programs, которые транзакция
+            # может удалить, поэтому сначала записываем их
+            _flush_pending(conn)
+            yield conn
+
+
+def _tuple_cursor(conn: sqlite3.Connection) -> sqlite3.Cursor:
+    """
+    Возвращает курсор, который отдает строки обычными кортежами вместо sqlite3.Row.
+    Используется в частых выборках, где колонки читаются позиционно в порядке SELECT.
     """
-    conn = get_connection()
     cursor = conn.cursor()
-    
-    # Таблица пользователей
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            username TEXT,
-            current_day TEXT
-        )
-    """)
-    
-    # Таблица программ тренировок (метаданные)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS workout_programs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            program_name TEXT NOT NULL,
-            program_type TEXT NOT NULL,
-            workout_count INTEGER,
-            created_at TEXT NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )
-    """)
-    
-    # Таблица программ тренировок (упражнения)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS programs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            program_id INTEGER,
-            user_id INTEGER NOT NULL,
-            day TEXT NOT NULL,
-            exercise TEXT NOT NULL,
-            sets INTEGER NOT NULL,
-            order_index INTEGER NOT NULL DEFAULT 0,
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            FOREIGN KEY (program_id) REFERENCES workout_programs(id) ON DELETE CASCADE
-        )
-    """)
-    
-    # Миграция: добавляем program_id, если его еще нет
-    try:
-        cursor.execute("ALTER TABLE programs ADD COLUMN program_id INTEGER")
-    except sqlite3.OperationalError:
-        pass
-    
-    # Миграция: добавляем order_index, если его еще нет
-    try:
-        cursor.execute("ALTER TABLE programs ADD COLUMN order_index INTEGER DEFAULT 0")
-        cursor.execute("UPDATE programs SET order_index = id WHERE order_index IS NULL")
-    except sqlite3.OperationalError:
-        pass
-    
-    # Таблица сессий тренировок (Workout ID)
-    # Создается когда пользователь начинает тренировку
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS workout_sessions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            program_id INTEGER,
-            day TEXT NOT NULL,
-            started_at TEXT NOT NULL,
-            completed_at TEXT,
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            FOREIGN KEY (program_id) REFERENCES workout_programs(id) ON DELETE SET NULL
-        )
-    """)
-    
-    # Таблица упражнений в тренировке (Exercise ID)
-    # Привязано к workout_session в определенном порядке
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS workout_exercises (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            workout_id INTEGER NOT NULL,
-            exercise_template_id INTEGER,
-            exercise_name TEXT NOT NULL,
-            order_index INTEGER NOT NULL,
-            FOREIGN KEY (workout_id) REFERENCES workout_sessions(id) ON DELETE CASCADE,
-            FOREIGN KEY (exercise_template_id) REFERENCES programs(id) ON DELETE SET NULL
-        )
-    """)
-    
-    # Таблица подходов в упражнении (Set ID)
-    # Привязано к workout_exercise в определенном порядке
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS exercise_sets (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            exercise_id INTEGER NOT NULL,
-            set_number INTEGER NOT NULL,
-            order_index INTEGER NOT NULL,
-            FOREIGN KEY (exercise_id) REFERENCES workout_exercises(id) ON DELETE CASCADE
-        )
-    """)
-    
-    # Таблица весов в подходе (Weight ID)
-    # Привязано к exercise_set
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS set_weights (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            set_id INTEGER NOT NULL,
-            weight REAL NOT NULL,
-            recorded_at TEXT NOT NULL,
-            FOREIGN KEY (set_id) REFERENCES exercise_sets(id) ON DELETE CASCADE
-        )
-    """)
-    
-    # Старая таблица results (для обратной совместимости, будет удалена позже)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS results (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            exercise_id INTEGER,
-            day TEXT NOT NULL,
-            exercise TEXT NOT NULL,
-            set_number INTEGER NOT NULL,
-            weight REAL,
-            date TEXT NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            FOREIGN KEY (exercise_id) REFERENCES programs(id) ON DELETE CASCADE
-        )
-    """)
-    
-    # Таблица тренировок по кнопкам
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS button_workouts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            workout_number INTEGER NOT NULL,
-            workout_name TEXT NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            UNIQUE(user_id, workout_number)
-        )
-    """)
-    
-    # Таблица упражнений для тренировок по кнопкам
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS button_workout_exercises (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            workout_number INTEGER NOT NULL,
-            exercise_name TEXT NOT NULL,
-            set_number INTEGER NOT NULL,
-            reps INTEGER,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )
-    """)
-    
-    # Таблица результатов для тренировок по кнопкам
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS button_workout_results (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            workout_number INTEGER NOT NULL,
-            exercise_name TEXT NOT NULL,
-            set_number INTEGER NOT NULL,
-            weight REAL,
-            date TEXT NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )
-    """)
-    
-    conn.commit()
-    conn.close()
+    cursor.row_factory = None
+    return cursor
 
 
-def add_user(user_id: int, username: str = None):
+def _fetch_scalar(conn: sqlite3.Connection, sql: str, params: tuple):
     """
-    Добавляет пользователя в базу данных, если его еще нет.
+    Выполняет запрос и возвращает первую колонку первой строки (или None, если строк нет).
+    """
+    row = _tuple_cursor(conn).execute(sql, params).fetchone()
+    return row[0] if row else None
+
+
+@lru_cache(maxsize=None)
+def _values_placeholders(width: int, count: int) -> str:
+    """Строка "(?, ?), (?, ?), ..." для многострочного VALUES: count строк по width колонок."""
+    row = "(" + ", ".join(["?"] * width) + ")"
+    return ", ".join([row] * count)
+
+
+def _insert_values(conn: sqlite3.Connection, insert_sql: str, rows: List[tuple], conflict_sql: str = ""):
+    """
+    Вставляет строки одним INSERT ... VALUES (...), (...) на пачку вместо запроса на строку.
+    Пачки режутся так, чтобы не превысить лимит параметров SQLite.
     
     Args:
-        user_id: ID пользователя в Telegram
-        username: Имя пользователя (опционально)
+        conn: Соединение с базой данных
+        insert_sql: Начало запроса до VALUES, например "INSERT INTO t (a, b)"
+        rows: Строки одинаковой длины
+        conflict_sql: Необязательное продолжение после VALUES (ON CONFLICT ...)
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Проверяем, существует ли пользователь
-    cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
-    if not cursor.fetchone():
-        cursor.execute(
-            "INSERT INTO users (id, username) VALUES (?, ?)",
-            (user_id, username)
+    if not rows:
+        return
+    
+    width = len(rows[0])
+    chunk_size = _MAX_SQL_PARAMS // width
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        conn.execute(
+            f"{insert_sql} VALUES {_values_placeholders(width, len(chunk))} {conflict_sql}",
+            tuple(chain.from_iterable(chunk))
         )
-        conn.commit()
-    
-    conn.close()
 
 
-def save_program(user_id: int, program_data: Dict[str, List[Dict]]):
+def _write_pending_rows(conn: sqlite3.Connection, sql: str, rows: List[tuple]):
+    """
+    Вставляет строки из буфера результатов.
+    Сначала пробует всю пачку одним executemany; если какая-то строка нарушает
+    ограничение (например, ссылается на уже удаленное упражнение), пачка откатывается
+    и строки пишутся по одной, каждая в своем SAVEPOINT. Строки с ошибкой
+    пропускаются с записью в лог, чтобы одна плохая строка не держала весь буфер.
+    """
+    conn.execute("SAVEPOINT flush_pending")
+    try:
+        conn.executemany(sql, rows)
+    except sqlite3.IntegrityError:
+        conn.execute("ROLLBACK TO flush_pending")
+        for row in rows:
+            conn.execute("SAVEPOINT flush_row")
+            try:
+                conn.execute(sql, row)
+            except sqlite3.IntegrityError as e:
+                conn.execute("ROLLBACK TO flush_row")
+                logger.warning(f"Результат подхода не записан и удален из буфера: {row!r} ({e})")
+            conn.execute("RELEASE flush_row")
+    conn.execute("RELEASE flush_pending")
+
+
+def _flush_pending(conn: sqlite3.Connection):
+    """
+    Записывает накопленные результаты подходов (вызывается под _LOCK внутри транзакции).
+    """
+    if not _pending_results and not _pending_button_results:
+        return
+    
+    user_ids = {row[0] for row in chain(_pending_results, _pending_button_results)}
+    conn.executemany(_SQL_ADD_USER, [(user_id, None) for user_id in user_ids])
+    if _pending_results:
+        _write_pending_rows(conn, _SQL_SAVE_RESULT, _pending_results)
+    if _pending_button_results:
+        _write_pending_rows(conn, _SQL_SAVE_BWR, _pending_button_results)
+    
+    # Строки с ошибкой целостности уже пропущены, остальные записаны. При других
+    # ошибках (например, база занята) сюда не доходим, и строки остаются в буфере
+    _pending_results.clear()
+    _pending_button_results.clear()
+
+
+def flush_results():
+    """
+    Записывает в базу все накопленные результаты подходов одной транзакцией.
+    Вызывается в конце тренировки и периодически из main.py.
+    """
+    with _locked_connection() as conn, conn:
+        _flush_pending(conn)
+
+
+def _copy_program(program: Dict[str, List[Dict]]) -> Dict[str, List[Dict]]:
+    """
+    Копирует программу из кэша, чтобы изменения у вызывающего не попали в кэш.
+    """
+    return {day: [dict(exercise) for exercise in exercises] for day, exercises in program.items()}
+
+
+def _ensure_user(conn: sqlite3.Connection, user_id: int):
+    """
+    Создает строку пользователя, если ее еще нет.
+    С включенными внешними ключами без нее вставка данных пользователя завершится ошибкой
+    (например, база пересоздана, а пользователь продолжает работать через меню без /start).
     """
-    Сохраняет программу тренировок пользователя.
-    Сначала удаляет старую программу, затем сохраняет новую.
+    conn.execute(_SQL_ADD_USER, (user_id, None))
+
+
+def init_db():
+    """
+    Инициализирует базу данных, создавая необходимые таблицы.
+    Вызывается при первом запуске бота.
+    """
+    with _locked_connection() as conn:
+        # Все таблицы создаются одним скриптом (executescript работает в autocommit)
+        conn.executescript("""
+            -- Таблица пользователей
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY,
+                username TEXT,
+                current_day TEXT
+            );
+            
+            -- Таблица программ тренировок (метаданные)
+            CREATE TABLE IF NOT EXISTS workout_programs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                program_name TEXT NOT NULL,
+                program_type TEXT NOT NULL,
+                workout_count INTEGER,
+                created_at TEXT NOT NULL,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            );
+            
+            -- Таблица программ тренировок (упражнения)
+            CREATE TABLE IF NOT EXISTS programs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                program_id INTEGER,
+                user_id INTEGER NOT NULL,
+                day TEXT NOT NULL,
+                exercise TEXT NOT NULL,
+                sets INTEGER NOT NULL,
+                order_index INTEGER NOT NULL DEFAULT 0,
+                FOREIGN KEY (user_id) REFERENCES users(id),
+                FOREIGN KEY (program_id) REFERENCES workout_programs(id) ON DELETE CASCADE
+            );
+            
+            -- Таблица сессий тренировок (Workout ID)
+            -- Создается когда пользователь начинает тренировку
+            CREATE TABLE IF NOT EXISTS workout_sessions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                program_id INTEGER,
+                day TEXT NOT NULL,
+                started_at TEXT NOT NULL,
+                completed_at TEXT,
+                FOREIGN KEY (user_id) REFERENCES users(id),
+                FOREIGN KEY (program_id) REFERENCES workout_programs(id) ON DELETE SET NULL
+            );
+            
+            -- Таблица упражнений в тренировке (Exercise ID)
+            -- Привязано к workout_session в определенном порядке
+            CREATE TABLE IF NOT EXISTS workout_exercises (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                workout_id INTEGER NOT NULL,
+                exercise_template_id INTEGER,
+                exercise_name TEXT NOT NULL,
+                order_index INTEGER NOT NULL,
+                FOREIGN KEY (workout_id) REFERENCES workout_sessions(id) ON DELETE CASCADE,
+                FOREIGN KEY (exercise_template_id) REFERENCES programs(id) ON DELETE SET NULL
+            );
+            
+            -- Таблица подходов в упражнении (Set ID)
+            -- Привязано к workout_exercise в определенном порядке
+            CREATE TABLE IF NOT EXISTS exercise_sets (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                exercise_id INTEGER NOT NULL,
+                set_number INTEGER NOT NULL,
+                order_index INTEGER NOT NULL,
+                FOREIGN KEY (exercise_id) REFERENCES workout_exercises(id) ON DELETE CASCADE
+            );
+            
+            -- Таблица весов в подходе (Weight ID)
+            -- Привязано к exercise_set
+            CREATE TABLE IF NOT EXISTS set_weights (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                set_id INTEGER NOT NULL,
+                weight REAL NOT NULL,
+                recorded_at TEXT NOT NULL,
+                FOREIGN KEY (set_id) REFERENCES exercise_sets(id) ON DELETE CASCADE
+            );
+            
+            -- Старая таблица results (для обратной совместимости, будет удалена позже)
+            CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                exercise_id INTEGER,
+                day TEXT NOT NULL,
+                exercise TEXT NOT NULL,
+                set_number INTEGER NOT NULL,
+                weight REAL,
+                date TEXT NOT NULL,
+                FOREIGN KEY (user_id) REFERENCES users(id),
+                FOREIGN KEY (exercise_id) REFERENCES programs(id) ON DELETE CASCADE
+            );
+            
+            -- Таблица тренировок по кнопкам
+            CREATE TABLE IF NOT EXISTS button_workouts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                workout_number INTEGER NOT NULL,
+                workout_name TEXT NOT NULL,
+                FOREIGN KEY (user_id) REFERENCES users(id),
+                UNIQUE(user_id, workout_number)
+            );
+            
+            -- Таблица упражнений для тренировок по кнопкам
+            CREATE TABLE IF NOT EXISTS button_workout_exercises (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                workout_number INTEGER NOT NULL,
+                exercise_name TEXT NOT NULL,
+                set_number INTEGER NOT NULL,
+                reps INTEGER,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            );
+            
+            -- Таблица результатов для тренировок по кнопкам
+            CREATE TABLE IF NOT EXISTS button_workout_results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                workout_number INTEGER NOT NULL,
+                exercise_name TEXT NOT NULL,
+                set_number INTEGER NOT NULL,
+                weight REAL,
+                date TEXT NOT NULL,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            );
+        """)
+        
+        # Одноразовые миграции старых баз: версия схемы хранится в PRAGMA user_version,
+        # поэтому при обычном перезапуске таблицы повторно не сканируются
+        version = _fetch_scalar(conn, "PRAGMA user_version", ())
+        migrated = version < _SCHEMA_VERSION
+        if migrated:
+            # Добавляем недостающие колонки programs
+            columns = {row[1] for row in _tuple_cursor(conn).execute("PRAGMA table_info(programs)")}
+            if 'program_id' not in columns:
+                conn.execute("ALTER TABLE programs ADD COLUMN program_id INTEGER")
+            if 'order_index' not in columns:
+                conn.execute("ALTER TABLE programs ADD COLUMN order_index INTEGER DEFAULT 0")
+                conn.execute("UPDATE programs SET order_index = id WHERE order_index IS NULL")
+            
+            # Подготовка к уникальному ключу для UPSERT в save_manual_program_workout:
+            # старые строки без order_index (по умолчанию 0) перенумеровываем по id
+            conn.executescript(f"""
+                BEGIN;
+                
+                UPDATE programs SET order_index = id
+                WHERE program_id IS NOT NULL AND (program_id, user_id, day) IN (
+                    SELECT program_id, user_id, day FROM programs
+                    WHERE program_id IS NOT NULL
+                    GROUP BY program_id, user_id, day, order_index
+                    HAVING COUNT(*) > 1
+                );
+                
+                -- Упражнения программ, удаленных до включения foreign_keys (каскад тогда
+                -- не срабатывал). Результаты по ним сохраняем: сначала отвязываем их,
+                -- иначе строки results удалит уже включенный каскад
+                UPDATE results SET exercise_id = NULL
+                WHERE exercise_id IN (
+                    SELECT id FROM programs
+                    WHERE program_id IS NOT NULL
+                    AND program_id NOT IN (SELECT id FROM workout_programs)
+                );
+                
+                DELETE FROM programs
+                WHERE program_id IS NOT NULL
+                AND program_id NOT IN (SELECT id FROM workout_programs);
+                
+                PRAGMA user_version = {_SCHEMA_VERSION};
+                
+                COMMIT;
+            """)
+        
+        # Индексы под частые выборки (последний вес, статистика, программа на день).
+        # Последний вес ищем по id: строки только добавляются, AUTOINCREMENT монотонен;
+        # weight в конце ключа делает idx_results_last_weight/idx_bwr_last_weight покрывающими
+        # (вес читается из индекса без обращения к таблице), они заменили idx_results_last/idx_bwr_last.
+        # idx_results_lookup/idx_bwr_lookup/idx_programs_user_day/idx_bwe_lookup заменены
+        # индексами с order_index (сортировка без temp B-tree) и idx_bwe_workout.
+        # idx_bwe_workout не уникальный: одно упражнение может повторяться в тренировке
+        # по кнопкам, поэтому бывший idx_bwe_uniq удаляется.
+        # idx_programs_by_program_uniq начинается с program_id: по нему же SQLite ищет
+        # дочерние строки при каскадном удалении программы (бывшие idx_programs_program и
+        # idx_programs_by_program), он же - ключ UPSERT в save_manual_program_workout
+        # (строки без программы с program_id = NULL между собой не конфликтуют).
+        # idx_programs_legacy_uniq (ключ UPSERT программы без ID) больше не нужен.
+        # idx_workout_exercises_template нужен для ON DELETE SET NULL при удалении упражнений.
+        # Индексы сессий тренировки: упражнения и подходы в порядке order_index, последний
+        # вес подхода - с конца idx_set_weights_last (rowid в индексе разрешает равные recorded_at)
+        conn.executescript("""
+            BEGIN;
+            
+            DROP INDEX IF EXISTS idx_results_lookup;
+            DROP INDEX IF EXISTS idx_bwr_lookup;
+            DROP INDEX IF EXISTS idx_programs_user_day;
+            DROP INDEX IF EXISTS idx_bwe_lookup;
+            DROP INDEX IF EXISTS idx_bwe_uniq;
+            DROP INDEX IF EXISTS idx_programs_legacy_uniq;
+            DROP INDEX IF EXISTS idx_programs_program;
+            DROP INDEX IF EXISTS idx_programs_by_program;
+            DROP INDEX IF EXISTS idx_results_last;
+            DROP INDEX IF EXISTS idx_bwr_last;
+            
+            CREATE INDEX IF NOT EXISTS idx_results_last_weight
+            ON results(user_id, exercise, set_number, id DESC, weight);
+            CREATE INDEX IF NOT EXISTS idx_results_stats
+            ON results(user_id, exercise, weight);
+            CREATE INDEX IF NOT EXISTS idx_results_exercise_id
+            ON results(exercise_id);
+            CREATE INDEX IF NOT EXISTS idx_programs_user_day_order
+            ON programs(user_id, day, order_index);
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_programs_by_program_uniq
+            ON programs(program_id, user_id, day, order_index);
+            CREATE INDEX IF NOT EXISTS idx_workout_exercises_template
+            ON workout_exercises(exercise_template_id);
+            CREATE INDEX IF NOT EXISTS idx_workout_exercises_workout
+            ON workout_exercises(workout_id, order_index);
+            CREATE INDEX IF NOT EXISTS idx_exercise_sets_exercise
+            ON exercise_sets(exercise_id, order_index);
+            CREATE INDEX IF NOT EXISTS idx_set_weights_last
+            ON set_weights(set_id, recorded_at, weight);
+            CREATE INDEX IF NOT EXISTS idx_bwr_last_weight
+            ON button_workout_results(user_id, workout_number, exercise_name, set_number, id DESC, weight);
+            CREATE INDEX IF NOT EXISTS idx_bwe_workout
+            ON button_workout_exercises(user_id, workout_number, exercise_name, set_number);
+            
+            COMMIT;
+        """)
+        
+        # После миграции собираем статистику заново, чтобы планировщик использовал индексы.
+        # Иначе - PRAGMA optimize с проверкой всех таблиц (0x10002): анализирует только те,
+        # где статистики нет (например, у только что созданного индекса) или она устарела;
+        # дальше ее поддерживает maintenance / close_connection
+        if migrated:
+            conn.execute("ANALYZE")
+        else:
+            conn.execute("PRAGMA optimize=0x10002")
+
+def add_user(user_id: int, username: str = None):
+    """
+    Добавляет пользователя в базу данных, если его еще нет.
     
     Args:
-        user_id: ID пользователя
-        program_data: Словарь с данными программы {день: [упражнения]}
+        user_id: ID пользователя в Telegram
+        username: Имя пользователя (опционально)
     """
-    from collections import OrderedDict
-    
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Удаляем старую программу пользователя
-    cursor.execute("DELETE FROM programs WHERE user_id = ?", (user_id,))
-    
-    # Преобразуем в OrderedDict для гарантии сохранения порядка
-    if not isinstance(program_data, OrderedDict):
-        ordered_program = OrderedDict(program_data)
-    else:
-        ordered_program = program_data
-    
-    # Сохраняем новую программу с сохранением порядка
-    for day, exercises in ordered_program.items():
-        # Убеждаемся, что exercises - это список, сохраняющий порядок
-        exercises_list = list(exercises) if isinstance(exercises, list) else list(exercises)
-        for order_index, exercise_data in enumerate(exercises_list):
-            cursor.execute(
-                "INSERT INTO programs (user_id, day, exercise, sets, order_index) VALUES (?, ?, ?, ?, ?)",
-                (user_id, day, exercise_data['exercise'], exercise_data['sets'], order_index)
-            )
-    
-    conn.commit()
-    conn.close()
+    with _locked_connection() as conn, conn:
+        # Если пользователь уже есть, вставка игнорируется по первичному ключу
+        conn.execute(_SQL_ADD_USER, (user_id, username))
 
 
 def get_program(user_id: int, day: str = None) -> Dict[str, List[Dict]]:
@@ -259,44 +572,45 @@ def get_program(user_id: int, day: str = None) -> Dict[str, List[Dict]]:
     Returns:
         Словарь с программой {день: [упражнения]} в правильном порядке
     """
-    from collections import OrderedDict
-    
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    if day:
-        cursor.execute(
-            "SELECT day, exercise, sets, order_index FROM programs WHERE user_id = ? AND day = ? ORDER BY order_index",
-            (user_id, day)
-        )
-    else:
-        cursor.execute(
-            "SELECT day, exercise, sets, order_index FROM programs WHERE user_id = ? ORDER BY day, order_index",
-            (user_id,)
-        )
-    
-    rows = cursor.fetchall()
-    conn.close()
-    
-    # Используем OrderedDict для гарантии сохранения порядка
-    program = OrderedDict()
-    for row in rows:
-        day_name = row['day']
-        if day_name not in program:
-            program[day_name] = []
-        # Добавляем упражнение в правильном порядке (rows уже отсортированы по order_index)
-        program[day_name].append({
-            'exercise': row['exercise'],
-            'sets': row['sets'],
-            'order_index': row['order_index']  # Сохраняем order_index для отладки
-        })
-    
-    return program
+    with _locked_connection() as conn:
+        cached = _program_cache.get(user_id, {}).get((None, day))
+        if cached is not None:
+            return _copy_program(cached)
+        
+        if day:
+            cursor = _tuple_cursor(conn).execute(
+                "SELECT day, exercise, sets, order_index FROM programs WHERE user_id = ? AND day = ? ORDER BY order_index",
+                (user_id, day)
+            )
+        else:
+            cursor = _tuple_cursor(conn).execute(
+                "SELECT day, exercise, sets, order_index FROM programs WHERE user_id = ? ORDER BY day, order_index",
+                (user_id,)
+            )
+        
+        rows = cursor.fetchall()
+        
+        # rows уже отсортированы по day, order_index - группируем за один проход
+        program = {
+            day_name: [
+                {
+                    'exercise': exercise,
+                    'sets': sets,
+                    'order_index': order_index  # Сохраняем order_index для отладки
+                }
+                for _, exercise, sets, order_index in day_rows
+            ]
+            for day_name, day_rows in groupby(rows, key=itemgetter(0))
+        }
+        _program_cache.setdefault(user_id, {})[(None, day)] = program
+        
+        return _copy_program(program)
 
 
 def save_result(user_id: int, exercise_id: int, day: str, exercise: str, set_number: int, weight: float):
     """
     Сохраняет результат выполнения подхода.
+    Результат попадает в буфер и записывается в базу при его сбросе (см. flush_results).
     
     Args:
         user_id: ID пользователя
@@ -306,19 +620,17 @@ def save_result(user_id: int, exercise_id: int, day: str, exercise: str, set_num
         set_number: Номер подхода
         weight: Вес в кг
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
-    cursor.execute(
-        """INSERT INTO results (user_id, exercise_id, day, exercise, set_number, weight, date)
-           VALUES (?, ?, ?, ?, ?, ?, ?)""",
-        (user_id, exercise_id, day, exercise, set_number, weight, date)
-    )
-    
-    conn.commit()
-    conn.close()
+    with _locked_connection() as conn:
+        _stats_cache.pop(user_id, None)
+        
+        # Время подхода фиксируем сейчас: строка попадет в базу позже, при сбросе буфера
+        _pending_results.append(
+            (user_id, exercise_id, day, exercise, set_number, weight, time.time())
+        )
+        _last_weight_cache.setdefault(user_id, {})[(exercise, set_number)] = weight
+        if len(_pending_results) >= _RESULTS_FLUSH_SIZE:
+            with conn:
+                _flush_pending(conn)
 
 
 def get_last_weight(user_id: int, exercise: str, set_number: int) -> Optional[float]:
@@ -333,51 +645,82 @@ def get_last_weight(user_id: int, exercise: str, set_number: int) -> Optional[fl
     Returns:
         Последний вес или None, если записей нет
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        """SELECT weight FROM results 
-           WHERE user_id = ? AND exercise = ? AND set_number = ?
-           ORDER BY date DESC LIMIT 1""",
-        (user_id, exercise, set_number)
-    )
+    with _locked_connection() as conn:
+        user_cache = _last_weight_cache.setdefault(user_id, {})
+        key = (exercise, set_number)
+        if key in user_cache:
+            return user_cache[key]
+        
+        user_cache[key] = _fetch_scalar(conn, _SQL_GET_LAST_WEIGHT, (user_id, exercise, set_number))
+        return user_cache[key]
+
+
+def get_last_weights(user_id: int, keys: List[Tuple[str, int]]) -> Dict[Tuple[str, int], Optional[float]]:
+    """
+    Получает последние веса сразу для нескольких подходов одним запросом.
+    Заполняет кэш get_last_weight, поэтому вызов в начале тренировки
+    избавляет от отдельного запроса на каждом подходе.
     
-    row = cursor.fetchone()
-    conn.close()
+    Args:
+        user_id: ID пользователя
+        keys: Список пар (упражнение, номер подхода)
     
-    return row['weight'] if row else None
+    Returns:
+        Словарь {(упражнение, подход): последний вес или None}
+    """
+    with _locked_connection() as conn:
+        user_cache = _last_weight_cache.setdefault(user_id, {})
+        missing = {key for key in keys if key not in user_cache}
+        exercises = list(dict.fromkeys(exercise for exercise, _ in missing))
+        
+        for key in missing:
+            user_cache[key] = None
+        
+        # Значения остальных колонок при MAX(id) SQLite берет из строки с максимальным id,
+        # то есть из последней записи в группе; группы идут по индексу idx_results_last_weight
+        step = _MAX_SQL_PARAMS - 1
+        for start in range(0, len(exercises), step):
+            chunk = exercises[start:start + step]
+            cursor = _tuple_cursor(conn).execute(f"""
+                SELECT exercise, set_number, weight, MAX(id)
+                FROM results
+                WHERE user_id = ? AND exercise IN ({', '.join('?' * len(chunk))})
+                GROUP BY exercise, set_number
+            """, (user_id, *chunk))
+            for exercise, set_number, weight, _ in cursor:
+                if (exercise, set_number) in missing:
+                    user_cache[(exercise, set_number)] = weight
+        
+        return {key: user_cache[key] for key in keys}
 
 
 def get_stats(user_id: int) -> Dict[str, float]:
     """
-    Получает статистику по последним весам для каждого упражнения.
+    Получает статистику: максимальный вес, записанный по каждому упражнению.
     
     Args:
         user_id: ID пользователя
     
     Returns:
-        Словарь {упражнение: максимальный вес}
+        Словарь {упражнение: максимальный вес}, упражнения по алфавиту
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Получаем последний вес для каждого упражнения (максимальный из последних подходов)
-    cursor.execute("""
-        SELECT exercise, MAX(weight) as max_weight
-        FROM results
-        WHERE user_id = ?
-        GROUP BY exercise
-    """, (user_id,))
-    
-    rows = cursor.fetchall()
-    conn.close()
-    
-    stats = {}
-    for row in rows:
-        stats[row['exercise']] = row['max_weight']
-    
-    return stats
+    with _locked_connection() as conn:
+        cached = _stats_cache.get(user_id)
+        if cached is not None:
+            return dict(cached)
+        
+        if _pending_results:
+            with conn:
+                _flush_pending(conn)
+        
+        # GROUP BY выполняется по покрывающему индексу idx_results_stats без чтения таблицы,
+        # и группы уже идут по exercise, поэтому ORDER BY не добавляет сортировки;
+        # строки - кортежи (упражнение, максимальный вес), из них сразу собираем словарь
+        stats = dict(_tuple_cursor(conn).execute(_SQL_GET_STATS, (user_id,)).fetchall())
+        
+        _stats_cache[user_id] = stats
+        
+        return dict(stats)
 
 
 def save_button_workout(user_id: int, workout_number: int, workout_name: str, exercises: List[Dict]):
@@ -390,36 +733,37 @@ def save_button_workout(user_id: int, workout_number: int, workout_name: str, ex
         workout_name: Название тренировки
         exercises: Список упражнений [{'exercise': название, 'sets': [{set_number: 1, reps: 20}, ...]}]
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Сохраняем или обновляем тренировку
-    cursor.execute("""
-        INSERT OR REPLACE INTO button_workouts (user_id, workout_number, workout_name)
-        VALUES (?, ?, ?)
-    """, (user_id, workout_number, workout_name))
-    
-    # Удаляем старые упражнения для этой тренировки
-    cursor.execute("""
-        DELETE FROM button_workout_exercises 
-        WHERE user_id = ? AND workout_number = ?
-    """, (user_id, workout_number))
-    
-    # Сохраняем упражнения
-    for exercise in exercises:
-        exercise_name = exercise['exercise']
-        for set_data in exercise['sets']:
-            cursor.execute("""
-                INSERT INTO button_workout_exercises 
-                (user_id, workout_number, exercise_name, set_number, reps)
-                VALUES (?, ?, ?, ?, ?)
-            """, (user_id, workout_number, exercise_name, set_data['set_number'], set_data['reps']))
-    
-    conn.commit()
-    conn.close()
+    # Замена тренировки целиком выполняется одной транзакцией
+    with _immediate_transaction() as conn:
+        _ensure_user(conn, user_id)
+        _button_workouts_cache.pop(user_id, None)
+        _button_workout_rows_cache.pop(user_id, None)
+        # Сохраняем или обновляем тренировку (id строки при обновлении сохраняется)
+        conn.execute("""
+            INSERT INTO button_workouts (user_id, workout_number, workout_name)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id, workout_number) DO UPDATE SET workout_name = excluded.workout_name
+        """, (user_id, workout_number, workout_name))
+        
+        # Подходы заменяем целиком: одно упражнение может встречаться в тренировке
+        # несколько раз, поэтому (упражнение, подход) не ключ строки и сверять
+        # старые строки с новыми не по чему
+        conn.execute("""
+            DELETE FROM button_workout_exercises
+            WHERE user_id = ? AND workout_number = ?
+        """, (user_id, workout_number))
+        _insert_values(
+            conn,
+            "INSERT INTO button_workout_exercises (user_id, workout_number, exercise_name, set_number, reps)",
+            [
+                (user_id, workout_number, exercise['exercise'], set_data['set_number'], set_data['reps'])
+                for exercise in exercises
+                for set_data in exercise['sets']
+            ]
+        )
 
 
-def get_button_workouts(user_id: int) -> List[Dict]:
+def get_button_workouts(user_id: int) -> List[sqlite3.Row]:
     """
     Получает список всех тренировок по кнопкам пользователя.
     
@@ -427,74 +771,84 @@ def get_button_workouts(user_id: int) -> List[Dict]:
         user_id: ID пользователя
     
     Returns:
-        Список тренировок [{'workout_number': 1, 'workout_name': 'Ноги'}, ...]
+        Список строк sqlite3.Row с колонками workout_number и workout_name
+        (читаются как у словаря: workout['workout_name']), без промежуточных dict
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT workout_number, workout_name 
-        FROM button_workouts 
-        WHERE user_id = ? 
-        ORDER BY workout_number
-    """, (user_id,))
-    
-    rows = cursor.fetchall()
-    conn.close()
-    
-    return [{'workout_number': row['workout_number'], 'workout_name': row['workout_name']} 
-            for row in rows]
+    with _locked_connection() as conn:
+        cached = _button_workouts_cache.get(user_id)
+        if cached is not None:
+            return list(cached)
+        
+        cursor = conn.execute("""
+            SELECT workout_number, workout_name 
+            FROM button_workouts 
+            WHERE user_id = ? 
+            ORDER BY workout_number
+        """, (user_id,))
+        
+        # sqlite3.Row неизменяем, поэтому в кэше достаточно копировать список
+        workouts = cursor.fetchall()
+        _button_workouts_cache[user_id] = workouts
+        
+        return list(workouts)
 
 
-def get_button_workout_exercises(user_id: int, workout_number: int) -> List[Dict]:
+def get_button_workout_with_exercises(user_id: int, workout_number: int) -> Optional[Dict]:
     """
-    Получает упражнения для тренировки по кнопкам.
+    Получает одну тренировку по кнопкам вместе с упражнениями одним запросом.
     
     Args:
         user_id: ID пользователя
         workout_number: Номер тренировки
     
     Returns:
-        Список упражнений с подходами
+        {'workout_number': 1, 'workout_name': 'Ноги',
+        'exercises': [{'exercise': название, 'sets': [{set_number: 1, reps: 20}, ...]}]}
+        или None, если тренировки нет
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT exercise_name, set_number, reps
-        FROM button_workout_exercises
-        WHERE user_id = ? AND workout_number = ?
-        ORDER BY exercise_name, set_number
-    """, (user_id, workout_number))
-    
-    rows = cursor.fetchall()
-    conn.close()
-    
-    # Группируем по упражнениям
-    exercises = {}
-    for row in rows:
-        ex_name = row['exercise_name']
-        if ex_name not in exercises:
-            exercises[ex_name] = []
-        exercises[ex_name].append({
-            'set_number': row['set_number'],
-            'reps': row['reps']
-        })
-    
-    result = []
-    for ex_name, sets in exercises.items():
-        result.append({
-            'exercise': ex_name,
-            'sets': sets
-        })
-    
-    return result
+    with _locked_connection() as conn:
+        # В кэше лежат неизменяемые кортежи строк, словари собираются заново
+        # на каждый вызов: сессия тренировки может менять полученный результат
+        user_cache = _button_workout_rows_cache.setdefault(user_id, {})
+        rows = user_cache.get(workout_number)
+        if rows is None:
+            cursor = _tuple_cursor(conn).execute("""
+                SELECT w.workout_name, e.exercise_name, e.set_number, e.reps
+                FROM button_workouts w
+                LEFT JOIN button_workout_exercises e
+                    ON e.user_id = w.user_id AND e.workout_number = w.workout_number
+                WHERE w.user_id = ? AND w.workout_number = ?
+                ORDER BY e.exercise_name, e.set_number
+            """, (user_id, workout_number))
+            rows = cursor.fetchall()
+            user_cache[workout_number] = rows
+        
+        if not rows:
+            return None
+        
+        # У тренировки без упражнений LEFT JOIN дает одну строку с exercise_name = NULL
+        return {
+            'workout_number': workout_number,
+            'workout_name': rows[0][0],
+            'exercises': [
+                {
+                    'exercise': ex_name,
+                    'sets': [
+                        {'set_number': set_number, 'reps': reps}
+                        for _, _, set_number, reps in ex_rows
+                    ]
+                }
+                for ex_name, ex_rows in groupby(rows, key=itemgetter(1))
+                if ex_name is not None
+            ]
+        }
 
 
 def save_button_workout_result(user_id: int, workout_number: int, exercise_name: str, 
                                 set_number: int, weight: float):
     """
     Сохраняет результат выполнения подхода для тренировки по кнопкам.
+    Как и save_result, пишет в буфер, который сбрасывается flush_results.
     
     Args:
         user_id: ID пользователя
@@ -503,19 +857,14 @@ def save_button_workout_result(user_id: int, workout_number: int, exercise_name:
         set_number: Номер подхода
         weight: Вес в кг
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
-    cursor.execute("""
-        INSERT INTO button_workout_results 
-        (user_id, workout_number, exercise_name, set_number, weight, date)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (user_id, workout_number, exercise_name, set_number, weight, date))
-    
-    conn.commit()
-    conn.close()
+    with _locked_connection() as conn:
+        _pending_button_results.append(
+            (user_id, workout_number, exercise_name, set_number, weight, time.time())
+        )
+        _last_button_weight_cache.setdefault(user_id, {})[(workout_number, exercise_name, set_number)] = weight
+        if len(_pending_button_results) >= _RESULTS_FLUSH_SIZE:
+            with conn:
+                _flush_pending(conn)
 
 
 def get_last_button_workout_weight(user_id: int, workout_number: int, exercise_name: str, 
@@ -532,19 +881,61 @@ def get_last_button_workout_weight(user_id: int, workout_number: int, exercise_n
     Returns:
         Последний вес или None
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT weight FROM button_workout_results 
-        WHERE user_id = ? AND workout_number = ? AND exercise_name = ? AND set_number = ?
-        ORDER BY date DESC LIMIT 1
-    """, (user_id, workout_number, exercise_name, set_number))
+    with _locked_connection() as conn:
+        user_cache = _last_button_weight_cache.setdefault(user_id, {})
+        key = (workout_number, exercise_name, set_number)
+        if key in user_cache:
+            return user_cache[key]
+        
+        user_cache[key] = _fetch_scalar(
+            conn, _SQL_GET_LAST_BWR_WEIGHT,
+            (user_id, workout_number, exercise_name, set_number)
+        )
+        return user_cache[key]
+
+
+def get_last_button_workout_weights(user_id: int, workout_number: int,
+                                    keys: List[Tuple[str, int]]) -> Dict[Tuple[str, int], Optional[float]]:
+    """
+    Получает последние веса для нескольких подходов тренировки по кнопкам одним запросом.
+    Заполняет кэш get_last_button_workout_weight.
     
-    row = cursor.fetchone()
-    conn.close()
+    Args:
+        user_id: ID пользователя
+        workout_number: Номер тренировки
+        keys: Список пар (упражнение, номер подхода)
     
-    return row['weight'] if row else None
+    Returns:
+        Словарь {(упражнение, подход): последний вес или None}
+    """
+    with _locked_connection() as conn:
+        user_cache = _last_button_weight_cache.setdefault(user_id, {})
+        missing = {
+            (workout_number, exercise_name, set_number)
+            for exercise_name, set_number in keys
+            if (workout_number, exercise_name, set_number) not in user_cache
+        }
+        
+        if missing:
+            for key in missing:
+                user_cache[key] = None
+            
+            # Последняя запись в группе - строка с MAX(id) (см. get_last_weights)
+            cursor = _tuple_cursor(conn).execute("""
+                SELECT exercise_name, set_number, weight, MAX(id)
+                FROM button_workout_results
+                WHERE user_id = ? AND workout_number = ?
+                GROUP BY exercise_name, set_number
+            """, (user_id, workout_number))
+            for exercise_name, set_number, weight, _ in cursor:
+                key = (workout_number, exercise_name, set_number)
+                if key in missing:
+                    user_cache[key] = weight
+        
+        return {
+            (exercise_name, set_number): user_cache[(workout_number, exercise_name, set_number)]
+            for exercise_name, set_number in keys
+        }
 
 
 # ========== Функции для работы с программами тренировок ==========
@@ -562,21 +953,17 @@ def create_workout_program(user_id: int, program_name: str, program_type: str, w
     Returns:
         ID созданной программы
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
-    cursor.execute("""
-        INSERT INTO workout_programs (user_id, program_name, program_type, workout_count, created_at)
-        VALUES (?, ?, ?, ?, ?)
-    """, (user_id, program_name, program_type, workout_count, created_at))
-    
-    program_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    
-    return program_id
+    with _locked_connection() as conn, conn:
+        _ensure_user(conn, user_id)
+        _user_programs_cache.pop(user_id, None)
+        cursor = conn.execute("""
+            INSERT INTO workout_programs (user_id, program_name, program_type, workout_count, created_at)
+            VALUES (?, ?, ?, ?, datetime('now', 'localtime'))
+        """, (user_id, program_name, program_type, workout_count))
+        
+        program_id = cursor.lastrowid
+        
+        return program_id
 
 
 def save_program_with_id(user_id: int, program_id: int, program_data: Dict[str, List[Dict]]):
@@ -588,36 +975,28 @@ def save_program_with_id(user_id: int, program_id: int, program_data: Dict[str,
         program_id: ID программы
         program_data: Словарь с данными программы {день: [упражнения]}
     """
-    from collections import OrderedDict
-    
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Удаляем старые упражнения для этой программы
-    cursor.execute("DELETE FROM programs WHERE program_id = ? AND user_id = ?", (program_id, user_id))
-    
-    # Преобразуем в OrderedDict для гарантии сохранения порядка
-    if not isinstance(program_data, OrderedDict):
-        ordered_program = OrderedDict(program_data)
-    else:
-        ordered_program = program_data
-    
-    # Сохраняем новую программу с сохранением порядка
-    # Важно: используем явную итерацию по OrderedDict для сохранения порядка дней
-    for day, exercises in ordered_program.items():
-        # Убеждаемся, что exercises - это список, сохраняющий порядок
-        # Создаем новый список, чтобы гарантировать порядок
-        exercises_list = list(exercises) if isinstance(exercises, list) else list(exercises)
-        
-        # Сохраняем упражнения в правильном порядке с явным order_index
-        for order_index, exercise_data in enumerate(exercises_list):
-            cursor.execute(
-                "INSERT INTO programs (program_id, user_id, day, exercise, sets, order_index) VALUES (?, ?, ?, ?, ?, ?)",
+    with _immediate_transaction() as conn:
+        _ensure_user(conn, user_id)
+        _program_cache.pop(user_id, None)
+        
+        # Удаляем старые упражнения для этой программы (история результатов остается)
+        conn.execute("""
+            UPDATE results SET exercise_id = NULL
+            WHERE exercise_id IN (SELECT id FROM programs WHERE program_id = ? AND user_id = ?)
+        """, (program_id, user_id))
+        conn.execute("DELETE FROM programs WHERE program_id = ? AND user_id = ?", (program_id, user_id))
+        
+        # Сохраняем новую программу: порядок дней - порядок ключей словаря,
+        # порядок упражнений фиксируется явным order_index
+        _insert_values(
+            conn,
+            "INSERT INTO programs (program_id, user_id, day, exercise, sets, order_index)",
+            [
                 (program_id, user_id, day, exercise_data['exercise'], exercise_data['sets'], order_index)
-            )
-    
-    conn.commit()
-    conn.close()
+                for day, exercises in program_data.items()
+                for order_index, exercise_data in enumerate(exercises)
+            ]
+        )
 
 
 def get_user_programs(user_id: int) -> List[Dict]:
@@ -630,28 +1009,66 @@ def get_user_programs(user_id: int) -> List[Dict]:
     Returns:
         Список программ [{'id': 1, 'program_name': '...', 'program_type': '...', 'workout_count': ...}, ...]
     """
-    conn = get_connection()
-    cursor = conn.cursor()
+    with _locked_connection() as conn:
+        cached = _user_programs_cache.get(user_id)
+        if cached is not None:
+            return [dict(program) for program in cached]
+        
+        cursor = _tuple_cursor(conn).execute("""
+            SELECT id, program_name, program_type, workout_count
+            FROM workout_programs
+            WHERE user_id = ?
+            ORDER BY created_at DESC
+        """, (user_id,))
+        
+        # Строки читаем прямо из курсора, без промежуточного списка
+        programs = [
+            {
+                'id': program_id,
+                'program_name': program_name,
+                'program_type': program_type,
+                'workout_count': workout_count
+            }
+            for program_id, program_name, program_type, workout_count in cursor
+        ]
+        _user_programs_cache[user_id] = programs
+        
+        return [dict(program) for program in programs]
+
+
+def get_user_program(user_id: int, program_id: int) -> Optional[Dict]:
+    """
+    Получает одну программу пользователя по ID.
+    
+    Args:
+        user_id: ID пользователя
+        program_id: ID программы
     
-    cursor.execute("""
-        SELECT id, program_name, program_type, workout_count
-        FROM workout_programs
-        WHERE user_id = ?
-        ORDER BY created_at DESC
-    """, (user_id,))
-    
-    rows = cursor.fetchall()
-    conn.close()
-    
-    return [
-        {
-            'id': row['id'],
-            'program_name': row['program_name'],
-            'program_type': row['program_type'],
-            'workout_count': row['workout_count']
+    Returns:
+        {'id': 1, 'program_name': '...', 'program_type': '...', 'workout_count': ...}
+        или None, если программы нет
+    """
+    with _locked_connection() as conn:
+        cached = _user_programs_cache.get(user_id)
+        if cached is not None:
+            return next((dict(program) for program in cached if program['id'] == program_id), None)
+        
+        row = _tuple_cursor(conn).execute("""
+            SELECT program_name, program_type, workout_count
+            FROM workout_programs
+            WHERE id = ? AND user_id = ?
+        """, (program_id, user_id)).fetchone()
+        
+        if row is None:
+            return None
+        
+        program_name, program_type, workout_count = row
+        return {
+            'id': program_id,
+            'program_name': program_name,
+            'program_type': program_type,
+            'workout_count': workout_count
         }
-        for row in rows
-    ]
 
 
 def get_program_by_id(user_id: int, program_id: int, day: str = None) -> Dict[str, List[Dict]]:
@@ -667,44 +1084,83 @@ def get_program_by_id(user_id: int, program_id: int, day: str = None) -> Dict[st
         Словарь с программой {день: [упражнения]} в правильном порядке
         Каждое упражнение содержит: exercise_id, exercise, sets
     """
-    from collections import OrderedDict
+    with _locked_connection() as conn:
+        cached = _program_cache.get(user_id, {}).get((program_id, day))
+        if cached is not None:
+            return _copy_program(cached)
+        
+        if day:
+            cursor = _tuple_cursor(conn).execute("""
+                SELECT id, day, exercise, sets, order_index 
+                FROM programs 
+                WHERE user_id = ? AND program_id = ? AND day = ? 
+                ORDER BY order_index
+            """, (user_id, program_id, day))
+        else:
+            cursor = _tuple_cursor(conn).execute("""
+                SELECT id, day, exercise, sets, order_index 
+                FROM programs 
+                WHERE user_id = ? AND program_id = ? 
+                ORDER BY day, order_index
+            """, (user_id, program_id))
+        
+        rows = cursor.fetchall()
+        
+        # rows уже отсортированы по day, order_index - группируем за один проход
+        program = {
+            day_name: [
+                {
+                    'exercise_id': exercise_id,  # ID упражнения из таблицы programs
+                    'exercise': exercise,
+                    'sets': sets,
+                    'order_index': order_index  # Сохраняем order_index для отладки
+                }
+                for exercise_id, _, exercise, sets, order_index in day_rows
+            ]
+            for day_name, day_rows in groupby(rows, key=itemgetter(1))
+        }
+        _program_cache.setdefault(user_id, {})[(program_id, day)] = program
+        
+        return _copy_program(program)
+
+
+def get_program_day_counts(user_id: int, program_ids: List[int]) -> Dict[int, int]:
+    """
+    Считает количество дней сразу в нескольких программах одним запросом
+    (для подписей кнопок вместо get_program_by_id на каждую программу).
+    Программы, уже лежащие в кэше get_program_by_id, в запрос не попадают.
     
-    conn = get_connection()
-    cursor = conn.cursor()
+    Args:
+        user_id: ID пользователя
+        program_ids: Список ID программ
     
-    if day:
-        cursor.execute("""
-            SELECT id, day, exercise, sets, order_index 
-            FROM programs 
-            WHERE user_id = ? AND program_id = ? AND day = ? 
-            ORDER BY order_index
-        """, (user_id, program_id, day))
-    else:
-        cursor.execute("""
-            SELECT id, day, exercise, sets, order_index 
-            FROM programs 
-            WHERE user_id = ? AND program_id = ? 
-            ORDER BY day, order_index
-        """, (user_id, program_id))
-    
-    rows = cursor.fetchall()
-    conn.close()
-    
-    # Используем OrderedDict для гарантии сохранения порядка
-    program = OrderedDict()
-    for row in rows:
-        day_name = row['day']
-        if day_name not in program:
-            program[day_name] = []
-        # Добавляем упражнение в правильном порядке (rows уже отсортированы по order_index)
-        program[day_name].append({
-            'exercise_id': row['id'],  # ID упражнения из таблицы programs
-            'exercise': row['exercise'],
-            'sets': row['sets'],
-            'order_index': row['order_index']  # Сохраняем order_index для отладки
-        })
-    
-    return program
+    Returns:
+        Словарь {program_id: количество дней}, 0 для программ без упражнений
+    """
+    with _locked_connection() as conn:
+        user_cache = _program_cache.get(user_id, {})
+        counts = {}
+        missing = []
+        for program_id in dict.fromkeys(program_ids):
+            cached = user_cache.get((program_id, None))
+            if cached is not None:
+                counts[program_id] = len(cached)
+            else:
+                counts[program_id] = 0
+                missing.append(program_id)
+        
+        step = _MAX_SQL_PARAMS - 1
+        for start in range(0, len(missing), step):
+            chunk = missing[start:start + step]
+            cursor = _tuple_cursor(conn).execute(f"""
+                SELECT program_id, COUNT(DISTINCT day)
+                FROM programs
+                WHERE user_id = ? AND program_id IN ({', '.join('?' * len(chunk))})
+                GROUP BY program_id
+            """, (user_id, *chunk))
+            counts.update(cursor)
+        
+        return counts
 
 
 def delete_workout_program(user_id: int, program_id: int):
@@ -715,17 +1171,23 @@ def delete_workout_program(user_id: int, program_id: int):
         user_id: ID пользователя
         program_id: ID программы
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Удаляем программу (упражнения удалятся автоматически через CASCADE)
-    cursor.execute("""
-        DELETE FROM workout_programs 
-        WHERE id = ? AND user_id = ?
-    """, (program_id, user_id))
-    
-    conn.commit()
-    conn.close()
+    with _locked_connection() as conn, conn:
+        _flush_pending(conn)  # Отложенные результаты тоже нужно отвязать от упражнений
+        _program_cache.pop(user_id, None)
+        _user_programs_cache.pop(user_id, None)
+        
+        # История результатов остается: отвязываем их от упражнений программы,
+        # иначе каскад по results.exercise_id удалит их вместе с упражнениями
+        conn.execute("""
+            UPDATE results SET exercise_id = NULL
+            WHERE exercise_id IN (SELECT id FROM programs WHERE program_id = ? AND user_id = ?)
+        """, (program_id, user_id))
+        
+        # Удаляем программу (упражнения удалятся автоматически через CASCADE)
+        conn.execute("""
+            DELETE FROM workout_programs 
+            WHERE id = ? AND user_id = ?
+        """, (program_id, user_id))
 
 
 # ========== Функции для работы с новой структурой тренировок ==========
@@ -742,94 +1204,52 @@ def create_workout_session(user_id: int, program_id: int = None, day: str = None
     Returns:
         ID созданной сессии тренировки (Workout ID)
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    started_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
-    cursor.execute("""
-        INSERT INTO workout_sessions (user_id, program_id, day, started_at)
-        VALUES (?, ?, ?, ?)
-    """, (user_id, program_id, day, started_at))
-    
-    workout_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    
-    return workout_id
+    with _locked_connection() as conn, conn:
+        _ensure_user(conn, user_id)
+        cursor = conn.execute("""
+            INSERT INTO workout_sessions (user_id, program_id, day, started_at)
+            VALUES (?, ?, ?, datetime('now', 'localtime'))
+        """, (user_id, program_id, day))
+        
+        workout_id = cursor.lastrowid
+        
+        return workout_id
 
 
-def add_workout_exercise(workout_id: int, exercise_template_id: int = None, exercise_name: str = None, order_index: int = None) -> int:
+def add_workout_exercises(workout_id: int, exercises: List[Dict]) -> List[int]:
     """
-    Добавляет упражнение в тренировку (Exercise ID).
+    Добавляет в тренировку все упражнения вместе с подходами одной транзакцией.
     
     Args:
         workout_id: ID сессии тренировки
-        exercise_template_id: ID упражнения из шаблона (опционально)
-        exercise_name: Название упражнения
-        order_index: Порядковый номер упражнения в тренировке
-    
-    Returns:
-        ID созданного упражнения (Exercise ID)
-    """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Если order_index не указан, определяем автоматически
-    if order_index is None:
-        cursor.execute("""
-            SELECT COALESCE(MAX(order_index), -1) + 1 
-            FROM workout_exercises 
-            WHERE workout_id = ?
-        """, (workout_id,))
-        order_index = cursor.fetchone()[0]
-    
-    cursor.execute("""
-        INSERT INTO workout_exercises (workout_id, exercise_template_id, exercise_name, order_index)
-        VALUES (?, ?, ?, ?)
-    """, (workout_id, exercise_template_id, exercise_name, order_index))
-    
-    exercise_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    
-    return exercise_id
-
-
-def add_exercise_set(exercise_id: int, set_number: int, order_index: int = None) -> int:
-    """
-    Добавляет подход к упражнению (Set ID).
-    
-    Args:
-        exercise_id: ID упражнения
-        set_number: Номер подхода (1, 2, 3, ...)
-        order_index: Порядковый номер подхода (опционально)
+        exercises: Упражнения в нужном порядке [{'exercise_id': ID шаблона, 'exercise': название, 'sets': кол-во подходов}, ...]
     
     Returns:
-        ID созданного подхода (Set ID)
+        Список ID созданных упражнений (Exercise ID) в том же порядке
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Если order_index не указан, определяем автоматически
-    if order_index is None:
-        cursor.execute("""
-            SELECT COALESCE(MAX(order_index), -1) + 1 
-            FROM exercise_sets 
-            WHERE exercise_id = ?
-        """, (exercise_id,))
-        order_index = cursor.fetchone()[0]
-    
-    cursor.execute("""
-        INSERT INTO exercise_sets (exercise_id, set_number, order_index)
-        VALUES (?, ?, ?)
-    """, (exercise_id, set_number, order_index))
-    
-    set_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    
-    return set_id
+    with _locked_connection() as conn, conn:
+        exercise_ids = []
+        set_rows = []
+        for order_index, exercise_data in enumerate(exercises):
+            # ID упражнения нужен для подходов, поэтому упражнения вставляем по одному
+            cursor = conn.execute("""
+                INSERT INTO workout_exercises (workout_id, exercise_template_id, exercise_name, order_index)
+                VALUES (?, ?, ?, ?)
+            """, (workout_id, exercise_data.get('exercise_id'), exercise_data['exercise'], order_index))
+            exercise_id = cursor.lastrowid
+            exercise_ids.append(exercise_id)
+            set_rows.extend(
+                (exercise_id, set_number, set_number - 1)
+                for set_number in range(1, exercise_data['sets'] + 1)
+            )
+        
+        # Подходы всех упражнений - одним пакетом
+        conn.executemany("""
+            INSERT INTO exercise_sets (exercise_id, set_number, order_index)
+            VALUES (?, ?, ?)
+        """, set_rows)
+        
+        return exercise_ids
 
 
 def save_set_weight(set_id: int, weight: float) -> int:
@@ -843,21 +1263,15 @@ def save_set_weight(set_id: int, weight: float) -> int:
     Returns:
         ID созданной записи веса (Weight ID)
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    recorded_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
-    cursor.execute("""
-        INSERT INTO set_weights (set_id, weight, recorded_at)
-        VALUES (?, ?, ?)
-    """, (set_id, weight, recorded_at))
-    
-    weight_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    
-    return weight_id
+    with _locked_connection() as conn, conn:
+        cursor = conn.execute("""
+            INSERT INTO set_weights (set_id, weight, recorded_at)
+            VALUES (?, ?, datetime('now', 'localtime'))
+        """, (set_id, weight))
+        
+        weight_id = cursor.lastrowid
+        
+        return weight_id
 
 
 def get_workout_exercises(workout_id: int) -> List[Dict]:
@@ -870,60 +1284,38 @@ def get_workout_exercises(workout_id: int) -> List[Dict]:
     Returns:
         Список упражнений с их подходами в правильном порядке
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT id, exercise_template_id, exercise_name, order_index
-        FROM workout_exercises
-        WHERE workout_id = ?
-        ORDER BY order_index
-    """, (workout_id,))
-    
-    exercises = []
-    for row in cursor.fetchall():
-        exercise_id = row['id']
-        
-        # Получаем подходы для этого упражнения
-        cursor.execute("""
-            SELECT id, set_number, order_index
-            FROM exercise_sets
-            WHERE exercise_id = ?
-            ORDER BY order_index
-        """, (exercise_id,))
+    with _locked_connection() as conn:
+        # Упражнения, их подходы и последний вес подхода одним запросом
+        cursor = _tuple_cursor(conn).execute("""
+            SELECT we.id, we.exercise_template_id, we.exercise_name,
+                   es.id, es.set_number,
+                   (
+                       SELECT sw.weight FROM set_weights sw
+                       WHERE sw.set_id = es.id
+                       ORDER BY sw.recorded_at DESC, sw.id DESC
+                       LIMIT 1
+                   )
+            FROM workout_exercises we
+            LEFT JOIN exercise_sets es ON es.exercise_id = we.id
+            WHERE we.workout_id = ?
+            ORDER BY we.order_index, we.id, es.order_index
+        """, (workout_id,))
         
-        sets = []
-        for set_row in cursor.fetchall():
-            set_id = set_row['id']
-            
-            # Получаем вес для этого подхода (последний)
-            cursor.execute("""
-                SELECT weight, recorded_at
-                FROM set_weights
-                WHERE set_id = ?
-                ORDER BY recorded_at DESC
-                LIMIT 1
-            """, (set_id,))
-            
-            weight_row = cursor.fetchone()
-            weight = weight_row['weight'] if weight_row else None
-            
-            sets.append({
-                'set_id': set_id,
-                'set_number': set_row['set_number'],
-                'weight': weight
+        exercises = []
+        for (exercise_id, template_id, exercise_name), set_rows in groupby(cursor, key=itemgetter(0, 1, 2)):
+            exercises.append({
+                'exercise_id': exercise_id,
+                'exercise_template_id': template_id,
+                'exercise_name': exercise_name,
+                # У упражнения без подходов LEFT JOIN дает одну строку с set_id = NULL
+                'sets': [
+                    {'set_id': set_id, 'set_number': set_number, 'weight': weight}
+                    for _, _, _, set_id, set_number, weight in set_rows
+                    if set_id is not None
+                ]
             })
         
-        exercises.append({
-            'exercise_id': exercise_id,
-            'exercise_template_id': row['exercise_template_id'],
-            'exercise_name': row['exercise_name'],
-            'sets': sets
-        })
-    
-    conn.close()
-    return exercises
-
+        return exercises
 
 def get_current_set_id(workout_id: int, exercise_order: int, set_number: int) -> Optional[int]:
     """
@@ -937,41 +1329,26 @@ def get_current_set_id(workout_id: int, exercise_order: int, set_number: int) ->
     Returns:
         ID подхода или None
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Получаем exercise_id по порядковому номеру
-    cursor.execute("""
-        SELECT id FROM workout_exercises
-        WHERE workout_id = ?
-        ORDER BY order_index
-        LIMIT 1 OFFSET ?
-    """, (workout_id, exercise_order))
-    
-    row = cursor.fetchone()
-    if not row:
-        conn.close()
-        return None
-    
-    exercise_id = row['id']
-    
-    # Получаем set_id по номеру подхода
-    cursor.execute("""
-        SELECT id FROM exercise_sets
-        WHERE exercise_id = ? AND set_number = ?
-        ORDER BY order_index
-        LIMIT 1
-    """, (exercise_id, set_number))
-    
-    row = cursor.fetchone()
-    conn.close()
-    
-    return row['id'] if row else None
+    with _locked_connection() as conn:
+        # Упражнение по порядковому номеру ищем подзапросом, а не соединением: OFFSET
+        # должен отсчитывать упражнения, а не строки после фильтра по set_number
+        return _fetch_scalar(conn, """
+            SELECT id FROM exercise_sets
+            WHERE exercise_id = (
+                SELECT id FROM workout_exercises
+                WHERE workout_id = ?
+                ORDER BY order_index
+                LIMIT 1 OFFSET ?
+            ) AND set_number = ?
+            ORDER BY order_index
+            LIMIT 1
+        """, (workout_id, exercise_order, set_number))
 
 
 def save_manual_program_workout(user_id: int, program_id: int, workout_number: int, exercises: List[Dict]):
     """
     Сохраняет тренировку ручной программы в таблицу programs.
+    Перезаписывает только изменившиеся упражнения и удаляет исчезнувшие.
     
     Args:
         user_id: ID пользователя
@@ -979,27 +1356,45 @@ def save_manual_program_workout(user_id: int, program_id: int, workout_number: i
         workout_number: Номер тренировки (1, 2, 3, ...)
         exercises: Список упражнений [{'exercise': название, 'sets': [{set_number: 1, reps: 20}, ...]}]
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
     # Используем "Тренировка N" как день недели
     day = f"Тренировка {workout_number}"
     
-    # Удаляем старые упражнения для этой тренировки
-    cursor.execute("""
-        DELETE FROM programs 
-        WHERE program_id = ? AND user_id = ? AND day = ?
-    """, (program_id, user_id, day))
+    # Новая тренировка: позиция -> (упражнение, подходы)
+    new_rows = {
+        order_index: (exercise['exercise'], len(exercise['sets']))
+        for order_index, exercise in enumerate(exercises)
+    }
     
-    # Сохраняем упражнения
-    for order_index, exercise in enumerate(exercises):
-        exercise_name = exercise['exercise']
-        sets_count = len(exercise['sets'])
+    with _immediate_transaction() as conn:
+        _ensure_user(conn, user_id)
+        _program_cache.pop(user_id, None)
         
-        cursor.execute("""
-            INSERT INTO programs (program_id, user_id, day, exercise, sets, order_index)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (program_id, user_id, day, exercise_name, sets_count, order_index))
-    
-    conn.commit()
-    conn.close()
+        # Текущие упражнения тренировки: позиция -> (id, упражнение, подходы)
+        cursor = conn.execute("""
+            SELECT id, order_index, exercise, sets
+            FROM programs
+            WHERE program_id = ? AND user_id = ? AND day = ?
+        """, (program_id, user_id, day))
+        old_rows = {
+            order_index: (row_id, exercise, sets)
+            for row_id, order_index, exercise, sets in cursor.fetchall()
+        }
+        
+        # Удаляем позиции, которых нет в новой тренировке (история результатов остается)
+        stale_ids = [(row_id,) for key, (row_id, _, _) in old_rows.items() if key not in new_rows]
+        conn.executemany(_SQL_DETACH_RESULTS, stale_ids)
+        conn.executemany("DELETE FROM programs WHERE id = ?", stale_ids)
+        
+        # Вставляем новые и обновляем изменившиеся упражнения, совпадающие не трогаем
+        _insert_values(
+            conn,
+            "INSERT INTO programs (program_id, user_id, day, exercise, sets, order_index)",
+            [
+                (program_id, user_id, day, exercise, sets, order_index)
+                for order_index, (exercise, sets) in new_rows.items()
+                if order_index not in old_rows
+                or old_rows[order_index][1:] != (exercise, sets)
+            ],
+            "ON CONFLICT(program_id, user_id, day, order_index) "
+            "DO UPDATE SET exercise = excluded.exercise, sets = excluded.sets"
+        )
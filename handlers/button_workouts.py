@@ -2,20 +2,25 @@
 Обработчик тренировок по кнопкам.
 Управляет созданием и выполнением тренировок через кнопки.
 """
+import asyncio
+import re
+
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from database import (
-    save_button_workout, get_button_workouts, get_button_workout_exercises,
-    save_button_workout_result, get_last_button_workout_weight,
-    save_manual_program_workout
+    save_button_workout, get_button_workouts, get_button_workout_with_exercises,
+    save_button_workout_result, get_last_button_workout_weight, get_last_button_workout_weights,
+    save_manual_program_workout, flush_results, get_user_program, get_program_by_id
 )
 from utils.keyboards import (
-    get_workout_count_keyboard, get_workout_buttons_keyboard,
+    get_workout_count_keyboard, get_workout_buttons_keyboard, get_create_workouts_keyboard,
     get_confirm_workout_keyboard, get_training_control_keyboard, get_confirm_keyboard
 )
 from parser import parse_exercise_with_reps
+from utils.helpers import WEIGHT_RE
+from utils.sessions import SessionStore
 import database
 
 router = Router()
@@ -29,13 +34,20 @@ class ButtonWorkoutState(StatesGroup):
     confirming_workout = State()  # Подтверждение тренировки
 
 
-# Хранилище текущих сессий создания тренировок
+# Хранилище текущих сессий создания тренировок (брошенные удаляются через час)
 # Формат: {user_id: {'workout_number': номер, 'workout_name': название, 'exercises': [...]}}
-workout_creation_sessions = {}
+workout_creation_sessions = SessionStore(ttl=60 * 60)
 
-# Хранилище текущих тренировок пользователей
+# Хранилище текущих тренировок пользователей (брошенные удаляются через 2 часа)
 # Формат: {user_id: {'workout_number': номер, 'exercises': [...], 'current_ex': индекс, 'current_set': номер}}
-button_training_sessions = {}
+button_training_sessions = SessionStore(ttl=2 * 60 * 60)
+
+# Непустая строка ввода упражнений без сокращений дней недели (в любом регистре):
+# строки с днями недели пропускаются, весь текст разбирается одним проходом finditer
+EXERCISE_LINE_RE = re.compile(
+    r'^(?!.*(?:ПН|ВТ|СР|ЧТ|ПТ|СБ|ВС)).*\S.*$',
+    re.MULTILINE | re.IGNORECASE
+)
 
 
 @router.callback_query(F.data == "mode_button_workouts")
@@ -60,27 +72,17 @@ async def process_workout_count(callback: CallbackQuery, state: FSMContext):
     Создает кнопки для каждой тренировки.
     """
     await callback.answer()
-    count = int(callback.data.split("_")[-1])
+    count = int(callback.data.rpartition("_")[2])
     
     user_id = callback.from_user.id
     
     # Сохраняем количество тренировок
     await state.update_data(workout_count=count)
     
-    # Создаем кнопки для каждой тренировки
-    buttons = []
-    for i in range(1, count + 1):
-        buttons.append([InlineKeyboardButton(
-            text=f"Тренировка {i}",
-            callback_data=f"create_workout_{i}"
-        )])
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    
     await callback.message.answer(
         f"✅ Создано {count} тренировок.\n\n"
         "Нажми на кнопку тренировки, чтобы начать её настройку:",
-        reply_markup=keyboard
+        reply_markup=get_create_workouts_keyboard(count)
     )
 
 
@@ -91,7 +93,7 @@ async def start_workout_creation(callback: CallbackQuery, state: FSMContext):
     Просит ввести название тренировки.
     """
     await callback.answer()
-    workout_number = int(callback.data.split("_")[-1])
+    workout_number = int(callback.data.rpartition("_")[2])
     
     await state.set_state(ButtonWorkoutState.waiting_for_workout_name)
     await state.update_data(workout_number=workout_number)
@@ -109,9 +111,9 @@ async def start_manual_workout_creation(callback: CallbackQuery, state: FSMConte
     Просит ввести упражнения.
     """
     await callback.answer()
-    parts = callback.data.split("_")
-    program_id = int(parts[-2])
-    workout_number = int(parts[-1])
+    _, program_id, workout_number = callback.data.rsplit("_", 2)
+    program_id = int(program_id)
+    workout_number = int(workout_number)
     
     await state.set_state(ButtonWorkoutState.waiting_for_exercises)
     await state.update_data(program_id=program_id, workout_number=workout_number)
@@ -167,20 +169,11 @@ async def process_exercises(message: Message, state: FSMContext):
     
     user_id = message.from_user.id
     
-    # Парсим упражнения
-    lines = text.split('\n')
+    # Парсим упражнения (пустые строки и строки с днями недели пропускаются)
     exercises = []
     
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        
-        # Пропускаем строки с днями недели
-        if any(day in line.upper() for day in ['ПН', 'ВТ', 'СР', 'ЧТ', 'ПТ', 'СБ', 'ВС']):
-            continue
-        
-        exercise_data = parse_exercise_with_reps(line)
+    for match in EXERCISE_LINE_RE.finditer(text):
+        exercise_data = parse_exercise_with_reps(match.group().strip())
         if exercise_data:
             exercises.append(exercise_data)
     
@@ -222,25 +215,25 @@ def format_button_workout_preview(workout_name: str, exercises: list) -> str:
     Returns:
         Отформатированная строка
     """
-    text = f"Ваша тренировка - {workout_name}\n\n"
+    lines = [f"Ваша тренировка - {workout_name}", ""]
     
     for exercise in exercises:
         exercise_name = exercise['exercise']
         sets = exercise['sets']
         
-        text += f"{exercise_name}\n"
+        lines.append(exercise_name)
         
         for set_data in sets:
             set_num = set_data['set_number']
             reps = set_data['reps']
             if reps:
-                text += f"{set_num} подход {reps} раз\n"
+                lines.append(f"{set_num} подход {reps} раз")
             else:
-                text += f"{set_num} подход\n"
+                lines.append(f"{set_num} подход")
         
-        text += "\n"
+        lines.append("")
     
-    return text
+    return "\n".join(lines) + "\n"
 
 
 @router.callback_query(F.data == "confirm_workout")
@@ -261,7 +254,8 @@ async def confirm_workout(callback: CallbackQuery, state: FSMContext):
     
     if program_id:
         # Это ручная программа - сохраняем в programs
-        save_manual_program_workout(
+        await asyncio.to_thread(
+            save_manual_program_workout,
             user_id,
             program_id,
             session['workout_number'],
@@ -273,14 +267,11 @@ async def confirm_workout(callback: CallbackQuery, state: FSMContext):
         )
         
         # Получаем данные о количестве тренировок
-        from database import get_user_programs
-        programs = get_user_programs(user_id)
-        program = next((p for p in programs if p['id'] == program_id), None)
+        program = await asyncio.to_thread(get_user_program, user_id, program_id)
         workout_count = program['workout_count'] if program else None
         
         # Получаем уже созданные тренировки для этой программы
-        from database import get_program_by_id
-        program_data = get_program_by_id(user_id, program_id)
+        program_data = await asyncio.to_thread(get_program_by_id, user_id, program_id)
         created_count = len([d for d in program_data.keys() if d.startswith("Тренировка ")])
         
         # Если не все тренировки созданы, показываем кнопки для создания оставшихся
@@ -314,7 +305,8 @@ async def confirm_workout(callback: CallbackQuery, state: FSMContext):
         return
     
     # Обычная тренировка по кнопкам - сохраняем в button_workouts
-    save_button_workout(
+    await asyncio.to_thread(
+        save_button_workout,
         user_id,
         session['workout_number'],
         session['workout_name'],
@@ -333,7 +325,7 @@ async def confirm_workout(callback: CallbackQuery, state: FSMContext):
     workout_count = data.get('workout_count')
     
     # Получаем уже созданные тренировки
-    workouts = get_button_workouts(user_id)
+    workouts = await asyncio.to_thread(get_button_workouts, user_id)
     created_count = len(workouts)
     
     # Если не все тренировки созданы, показываем кнопки для создания оставшихся
@@ -363,7 +355,6 @@ async def confirm_workout(callback: CallbackQuery, state: FSMContext):
     
     # Показываем меню тренировок для выполнения
     if workouts:
-        from utils.keyboards import get_workout_buttons_keyboard
         await callback.message.answer(
             "✅ Все тренировки созданы!\n\n"
             "Выбери тренировку для выполнения:",
@@ -393,15 +384,14 @@ async def select_workout(callback: CallbackQuery):
     Начинает тренировку.
     """
     await callback.answer()
-    workout_number = int(callback.data.split("_")[-1])
+    workout_number = int(callback.data.rpartition("_")[2])
     user_id = callback.from_user.id
     
     # Проверяем, это ручная программа или обычная тренировка по кнопкам
     if user_id in button_training_sessions and button_training_sessions[user_id].get('type') == 'manual_program':
         # Это ручная программа
         session = button_training_sessions[user_id]
-        workouts = session.get('workouts', [])
-        workout = next((w for w in workouts if w['workout_number'] == workout_number), None)
+        workout = session.get('workouts', {}).get(workout_number)
         
         if not workout:
             await callback.message.answer("❌ Тренировка не найдена")
@@ -426,35 +416,44 @@ async def select_workout(callback: CallbackQuery):
             'type': 'manual_program'
         }
     else:
-        # Обычная тренировка по кнопкам
-        exercises = get_button_workout_exercises(user_id, workout_number)
+        # Обычная тренировка по кнопкам: название и упражнения одним запросом
+        workout = await asyncio.to_thread(get_button_workout_with_exercises, user_id, workout_number)
         
-        if not exercises:
+        if not workout or not workout['exercises']:
             await callback.message.answer("❌ Тренировка не найдена")
             return
         
-        # Получаем название тренировки
-        workouts = get_button_workouts(user_id)
-        workout_name = next((w['workout_name'] for w in workouts if w['workout_number'] == workout_number), f"Тренировка {workout_number}")
-        
         # Сохраняем сессию тренировки
         button_training_sessions[user_id] = {
             'workout_number': workout_number,
-            'workout_name': workout_name,
-            'exercises': exercises,
+            'workout_name': workout['workout_name'],
+            'exercises': workout['exercises'],
             'current_ex': 0,
             'current_set': 0
         }
     
-    # Форматируем список упражнений
     session = button_training_sessions[user_id]
-    exercises_text = f"🏋️ {session['workout_name']}:\n\n"
+    
+    # Последние веса всех подходов одним запросом: дальше
+    # get_last_button_workout_weight берет их из кэша
+    await asyncio.to_thread(
+        get_last_button_workout_weights, user_id, workout_number,
+        [
+            (ex['exercise'], set_data['set_number'])
+            for ex in session['exercises'] if isinstance(ex['sets'], list)
+            for set_data in ex['sets']
+        ]
+    )
+    
+    # Форматируем список упражнений
+    lines = [f"🏋️ {session['workout_name']}:", ""]
     for i, ex in enumerate(session['exercises'], 1):
         if isinstance(ex['sets'], list):
             sets_count = len(ex['sets'])
         else:
             sets_count = ex['sets']
-        exercises_text += f"{i}. {ex['exercise']} — {sets_count} подходов\n"
+        lines.append(f"{i}. {ex['exercise']} — {sets_count} подходов")
+    exercises_text = "\n".join(lines) + "\n"
     
     await callback.message.answer(
         f"{exercises_text}\n"
@@ -475,34 +474,32 @@ async def ask_for_button_workout_weight(message: Message, user_id: int):
         await message.answer("❌ Сессия тренировки не найдена. Начни заново.")
         return
     
-    exercise = session['exercises'][session['current_ex']]
-    exercise_name = exercise['exercise']
-    sets = exercise['sets']
-    
-    if session['current_set'] >= len(sets):
-        # Переходим к следующему упражнению
+    # Переходим к следующему упражнению, если подходы текущего закончились
+    exercises = session['exercises']
+    while session['current_ex'] < len(exercises):
+        exercise = exercises[session['current_ex']]
+        if session['current_set'] < len(exercise['sets']):
+            break
         session['current_ex'] += 1
         session['current_set'] = 0
-        
-        if session['current_ex'] >= len(session['exercises']):
-            # Все упражнения завершены
-            del button_training_sessions[user_id]
-            await message.answer(
-                "🎉 Тренировка завершена! Отличная работа! 💪\n\n"
-                "Все результаты сохранены."
-            )
-            return
-        else:
-            exercise = session['exercises'][session['current_ex']]
-            exercise_name = exercise['exercise']
-            sets = exercise['sets']
+    else:
+        # Все упражнения завершены
+        del button_training_sessions[user_id]
+        await asyncio.to_thread(flush_results)
+        await message.answer(
+            "🎉 Тренировка завершена! Отличная работа! 💪\n\n"
+            "Все результаты сохранены."
+        )
+        return
     
-    current_set_data = sets[session['current_set']]
+    exercise_name = exercise['exercise']
+    current_set_data = exercise['sets'][session['current_set']]
     set_number = current_set_data['set_number']
     reps = current_set_data['reps']
     
     # Проверяем, есть ли предыдущий вес
-    last_weight = get_last_button_workout_weight(
+    last_weight = await asyncio.to_thread(
+        get_last_button_workout_weight,
         user_id, session['workout_number'], exercise_name, set_number
     )
     
@@ -522,7 +519,7 @@ async def ask_for_button_workout_weight(message: Message, user_id: int):
         )
 
 
-@router.message(F.text.regexp(r'^\d+([.,]\d+)?$'))
+@router.message(F.text.regexp(WEIGHT_RE))
 async def process_button_workout_weight(message: Message, state: FSMContext):
     """
     Обработчик ввода веса для тренировки по кнопкам.
@@ -533,12 +530,9 @@ async def process_button_workout_weight(message: Message, state: FSMContext):
     if not session:
         return
     
-    # Парсим вес
-    try:
-        weight = float(message.text.replace(',', '.'))
-        if weight <= 0:
-            return
-    except ValueError:
+    # Парсим вес: формат числа уже проверен фильтром WEIGHT_RE
+    weight = float(message.text.replace(',', '.'))
+    if weight <= 0:
         return
     
     exercise = session['exercises'][session['current_ex']]
@@ -548,7 +542,8 @@ async def process_button_workout_weight(message: Message, state: FSMContext):
     set_number = current_set_data['set_number']
     
     # Сохраняем вес
-    save_button_workout_result(
+    await asyncio.to_thread(
+        save_button_workout_result,
         user_id, session['workout_number'], exercise_name, set_number, weight
     )
     
@@ -578,7 +573,8 @@ async def confirm_button_workout_weight(callback: CallbackQuery, state: FSMConte
     set_number = current_set_data['set_number']
     
     # Получаем последний вес
-    last_weight = get_last_button_workout_weight(
+    last_weight = await asyncio.to_thread(
+        get_last_button_workout_weight,
         user_id, session['workout_number'], exercise_name, set_number
     )
     
@@ -587,7 +583,8 @@ async def confirm_button_workout_weight(callback: CallbackQuery, state: FSMConte
         return
     
     # Сохраняем вес
-    save_button_workout_result(
+    await asyncio.to_thread(
+        save_button_workout_result,
         user_id, session['workout_number'], exercise_name, set_number, last_weight
     )
     
@@ -608,6 +605,7 @@ async def end_button_workout_callback(callback: CallbackQuery):
     
     if user_id in button_training_sessions:
         del button_training_sessions[user_id]
+        await asyncio.to_thread(flush_results)
         await callback.answer("Тренировка завершена!", show_alert=True)
         await callback.message.answer("✅ Тренировка завершена! Отличная работа! 💪")
 
@@ -623,9 +621,6 @@ async def start_manual_program_creation(message: Message, program_id: int, worko
         program_id: ID программы
         workout_count: Количество тренировок
     """
-    from aiogram.fsm.context import FSMContext
-    from aiogram.fsm.state import State, StatesGroup
-    
     # Создаем кнопки для каждой тренировки
     buttons = []
     for i in range(1, workout_count + 1):
@@ -651,11 +646,8 @@ async def start_manual_program_training(message: Message, program_id: int):
         message: Сообщение от пользователя
         program_id: ID программы
     """
-    from database import get_program_by_id
-    from utils.keyboards import get_workout_buttons_keyboard
-    
     user_id = message.from_user.id
-    program = get_program_by_id(user_id, program_id)
+    program = await asyncio.to_thread(get_program_by_id, user_id, program_id)
     
     if not program:
         await message.answer("❌ Программа не найдена")
@@ -674,10 +666,11 @@ async def start_manual_program_training(message: Message, program_id: int):
     
     workouts.sort(key=lambda x: x['workout_number'])
     
-    # Сохраняем в сессию для тренировки
+    # Сохраняем в сессию для тренировки: {номер: тренировка}, чтобы
+    # select_workout находил выбранную тренировку без перебора списка
     button_training_sessions[user_id] = {
         'program_id': program_id,
-        'workouts': workouts,
+        'workouts': {w['workout_number']: w for w in workouts},
         'type': 'manual_program'
     }
     
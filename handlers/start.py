@@ -1,6 +1,10 @@
 """
 Обработчик команды /start и начальных сообщений.
 """
+import asyncio
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
 from aiogram.filters import Command
@@ -8,7 +12,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from database import (
     add_user, get_user_programs, create_workout_program, 
-    save_program_with_id, delete_workout_program, get_program_by_id
+    save_program_with_id, delete_workout_program, get_program_by_id, get_user_program
 )
 from utils.keyboards import (
     get_mode_selection_keyboard, get_save_program_keyboard,
@@ -16,11 +20,32 @@ from utils.keyboards import (
     get_delete_program_keyboard, get_restart_keyboard, get_main_keyboard,
     get_persistent_menu_keyboard
 )
-from parser import parse_program
+from parser import parse_program, get_current_day
+from utils.helpers import format_program_text
+from handlers.button_workouts import (
+    start_manual_program_creation, start_manual_program_training,
+    workout_creation_sessions, button_training_sessions
+)
+from handlers.training import start_training_session_with_program, training_sessions
+from handlers.stats import cmd_stats
 import database
 
 router = Router()
 
+# Примеры поддерживаемых форматов программы: подсказка при загрузке и при ошибке разбора
+PROGRAM_FORMATS_HELP = (
+    "1️⃣ Классический:\n"
+    "ПН: жим лёжа 3x10, присед 4x8; ВТ: подтягивания 3xмакс\n\n"
+    "2️⃣ С тире (многострочный):\n"
+    "📅 Понедельник:\n"
+    "Гакк-присед — 4х10\n"
+    "Жим ног — 3х12\n\n"
+    "3️⃣ С диапазонами повторений:\n"
+    "📅 Понедельник:\n"
+    "Гакк-присед — 20-16-14-12\n"
+    "Жим ног — 18-10-14"
+)
+
 
 class ProgramState(StatesGroup):
     """Состояния FSM для создания программ."""
@@ -30,6 +55,37 @@ class ProgramState(StatesGroup):
     waiting_for_workout_count = State()  # Ожидание количества тренировок
 
 
+@lru_cache(maxsize=256)
+def _parse_program_for_day(text: str, current_day: str) -> Tuple[Dict[str, List[Dict]], str]:
+    """
+    Кэшируемый разбор для parse_program_cached.
+    Текущий день входит в ключ: программе без заголовков дней parse_program
+    подставляет сегодняшний день, и на следующий день результат должен быть другим.
+    """
+    program = parse_program(text)
+    return program, format_program_text(program)
+
+
+def parse_program_cached(text: str) -> Tuple[Dict[str, List[Dict]], str]:
+    """
+    Парсит программу и форматирует ее для показа.
+    Повторно присланный текст (пользователь поправил и отправил снова) берется
+    из кэша; ValueError не кэшируется. Программа возвращается копией, поэтому
+    ее можно сохранять и изменять, не затрагивая кэш и других пользователей.
+    
+    Args:
+        text: Текст программы тренировок
+    
+    Returns:
+        Кортеж (программа {день: [упражнения]}, отформатированный текст программы)
+    
+    Raises:
+        ValueError: Если формат программы некорректный
+    """
+    program, program_text = _parse_program_for_day(text, get_current_day())
+    return {day: [dict(ex) for ex in exercises] for day, exercises in program.items()}, program_text
+
+
 @router.message(Command("start"))
 async def cmd_start(message: Message):
     """
@@ -40,10 +96,7 @@ async def cmd_start(message: Message):
     username = message.from_user.username
     
     # Добавляем пользователя в базу
-    add_user(user_id, username)
-    
-    programs = get_user_programs(user_id)
-    has_programs = len(programs) > 0
+    await asyncio.to_thread(add_user, user_id, username)
     
     # Устанавливаем постоянное меню
     await message.answer(
@@ -91,16 +144,7 @@ async def process_program_name_upload(message: Message, state: FSMContext):
     await message.answer(
         f"✅ Название сохранено: {program_name}\n\n"
         "Теперь отправь программу тренировок в любом формате:\n\n"
-        "1️⃣ Классический:\n"
-        "ПН: жим лёжа 3x10, присед 4x8; ВТ: подтягивания 3xмакс\n\n"
-        "2️⃣ С тире (многострочный):\n"
-        "📅 Понедельник:\n"
-        "Гакк-присед — 4х10\n"
-        "Жим ног — 3х12\n\n"
-        "3️⃣ С диапазонами:\n"
-        "📅 Понедельник:\n"
-        "Гакк-присед — 20-16-14-12\n"
-        "Жим ног — 18-10-14"
+        + PROGRAM_FORMATS_HELP
     )
 
 
@@ -115,18 +159,13 @@ async def handle_program_text(message: Message, state: FSMContext):
     
     # Пытаемся распарсить программу
     try:
-        program = parse_program(text)
-        
-        # Форматируем программу для отображения
-        from utils.helpers import format_program_text
-        program_text = format_program_text(program)
+        # Разбор и форматирование программы для отображения
+        program, program_text = parse_program_cached(text)
         
         # Сохраняем во временное хранилище
         data = await state.get_data()
         program_name = data.get('program_name')
         
-        if not hasattr(database, 'temp_programs'):
-            database.temp_programs = {}
         database.temp_programs[user_id] = {
             'program': program,
             'program_name': program_name,
@@ -143,16 +182,7 @@ async def handle_program_text(message: Message, state: FSMContext):
         await message.answer(
             f"❌ Ошибка при разборе программы: {str(e)}\n\n"
             "📝 Поддерживаемые форматы:\n\n"
-            "1️⃣ Классический:\n"
-            "ПН: жим лёжа 3x10, присед 4x8; ВТ: подтягивания 3xмакс\n\n"
-            "2️⃣ С тире (многострочный):\n"
-            "📅 Понедельник:\n"
-            "Гакк-присед — 4х10\n"
-            "Жим ног — 3х12\n\n"
-            "3️⃣ С диапазонами повторений:\n"
-            "📅 Понедельник:\n"
-            "Гакк-присед — 20-16-14-12\n"
-            "Жим ног — 18-10-14"
+            + PROGRAM_FORMATS_HELP
         )
 
 
@@ -213,21 +243,21 @@ async def process_workout_count(callback: CallbackQuery, state: FSMContext):
     Создает программу и переходит к созданию тренировок.
     """
     await callback.answer()
-    count = int(callback.data.split("_")[-1])
+    count = int(callback.data.rpartition("_")[2])
     
     user_id = callback.from_user.id
     data = await state.get_data()
     program_name = data.get('program_name')
     
     # Создаем программу в базе
-    program_id = create_workout_program(
+    program_id = await asyncio.to_thread(
+        create_workout_program,
         user_id, program_name, 'manual', workout_count=count
     )
     
     await state.clear()
     
     # Переходим к созданию тренировок через button_workouts
-    from handlers.button_workouts import start_manual_program_creation
     await start_manual_program_creation(callback.message, program_id, count)
 
 
@@ -240,7 +270,7 @@ async def save_program_callback(callback: CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     
     # Получаем временно сохраненную программу
-    if not hasattr(database, 'temp_programs') or user_id not in database.temp_programs:
+    if user_id not in database.temp_programs:
         await callback.answer("❌ Программа не найдена. Отправь программу заново.", show_alert=True)
         return
     
@@ -249,26 +279,28 @@ async def save_program_callback(callback: CallbackQuery, state: FSMContext):
     program_name = temp_data['program_name']
     
     # Создаем программу в базе
-    program_id = create_workout_program(
+    program_id = await asyncio.to_thread(
+        create_workout_program,
         user_id, program_name, 'uploaded'
     )
     
     # Сохраняем программу
-    save_program_with_id(user_id, program_id, program)
+    await asyncio.to_thread(save_program_with_id, user_id, program_id, program)
     
     # Удаляем из временного хранилища
     del database.temp_programs[user_id]
     await state.clear()
     
-    await callback.answer("✅ Программа сохранена!", show_alert=True)
-    await callback.message.edit_text(
-        callback.message.text + "\n\n✅ Программа сохранена!",
-        reply_markup=None
+    # Уведомление и правка сообщения с программой независимы - отправляем одновременно
+    await asyncio.gather(
+        callback.answer("✅ Программа сохранена!", show_alert=True),
+        callback.message.edit_text(
+            callback.message.text + "\n\n✅ Программа сохранена!",
+            reply_markup=None
+        )
     )
     
     # Показываем главное меню
-    programs = get_user_programs(user_id)
-    has_programs = len(programs) > 0
     await callback.message.answer(
         "Выбери режим работы:",
         reply_markup=get_mode_selection_keyboard()
@@ -290,7 +322,7 @@ async def start_training_button(message: Message):
     user_id = message.from_user.id
     
     # Получаем все программы пользователя
-    programs = get_user_programs(user_id)
+    programs = await asyncio.to_thread(get_user_programs, user_id)
     
     if not programs:
         await message.answer(
@@ -302,7 +334,8 @@ async def start_training_button(message: Message):
     
     await message.answer(
         "Выбери программу для тренировки:",
-        reply_markup=get_program_selection_keyboard(programs, user_id)
+        # Клавиатура считает дни программ запросами к БД
+        reply_markup=await asyncio.to_thread(get_program_selection_keyboard, programs, user_id)
     )
 
 
@@ -312,31 +345,28 @@ async def select_program(callback: CallbackQuery):
     Обработчик выбора программы для тренировки.
     """
     await callback.answer()
-    program_id = int(callback.data.split("_")[-1])
+    program_id = int(callback.data.rpartition("_")[2])
     user_id = callback.from_user.id
     
-    # Получаем программу
-    program = get_program_by_id(user_id, program_id)
+    # Тип программы (строка workout_programs по ID, без списка всех программ)
+    program_info = await asyncio.to_thread(get_user_program, user_id, program_id)
     
-    if not program:
+    if not program_info:
         await callback.message.answer("❌ Программа не найдена")
         return
     
-    # Определяем тип программы
-    programs = get_user_programs(user_id)
-    program_info = next((p for p in programs if p['id'] == program_id), None)
+    # Программа без упражнений считается ненайденной; дальше она берется из кэша
+    program = await asyncio.to_thread(get_program_by_id, user_id, program_id)
     
-    if not program_info:
+    if not program:
         await callback.message.answer("❌ Программа не найдена")
         return
     
     if program_info['program_type'] == 'manual':
         # Для ручных программ используем button_workouts
-        from handlers.button_workouts import start_manual_program_training
         await start_manual_program_training(callback.message, program_id)
     else:
         # Для загруженных программ используем training
-        from handlers.training import start_training_session_with_program
         await start_training_session_with_program(callback.message, program_id)
 
 
@@ -346,7 +376,6 @@ async def stats_button(message: Message):
     Обработчик кнопки "Статистика".
     Перенаправляет в модуль статистики.
     """
-    from handlers.stats import cmd_stats
     await cmd_stats(message)
 
 
@@ -362,27 +391,14 @@ async def restart_bot(message: Message, state: FSMContext):
     await state.clear()
     
     # Очищаем временные хранилища из других модулей
-    import handlers.button_workouts as button_workouts_module
-    if user_id in button_workouts_module.workout_creation_sessions:
-        del button_workouts_module.workout_creation_sessions[user_id]
-    if user_id in button_workouts_module.button_training_sessions:
-        del button_workouts_module.button_training_sessions[user_id]
+    workout_creation_sessions.pop(user_id, None)
+    button_training_sessions.pop(user_id, None)
     
     # Очищаем временные программы
-    if hasattr(database, 'temp_programs') and user_id in database.temp_programs:
-        del database.temp_programs[user_id]
+    database.temp_programs.pop(user_id, None)
     
     # Очищаем сессии тренировок из training.py
-    try:
-        import handlers.training as training_module
-        if hasattr(training_module, 'training_sessions') and user_id in training_module.training_sessions:
-            del training_module.training_sessions[user_id]
-    except:
-        pass
-    
-    # Проверяем наличие программ
-    programs = get_user_programs(user_id)
-    has_programs = len(programs) > 0
+    training_sessions.pop(user_id, None)
     
     await message.answer(
         "🔄 Бот перезагружен!\n\n"
@@ -414,7 +430,7 @@ async def delete_training_button(message: Message):
     """
     user_id = message.from_user.id
     
-    programs = get_user_programs(user_id)
+    programs = await asyncio.to_thread(get_user_programs, user_id)
     
     if not programs:
         await message.answer(
@@ -425,7 +441,8 @@ async def delete_training_button(message: Message):
     
     await message.answer(
         "Выбери программу для удаления:",
-        reply_markup=get_delete_program_keyboard(programs, user_id)
+        # Клавиатура считает дни программ запросами к БД
+        reply_markup=await asyncio.to_thread(get_delete_program_keyboard, programs, user_id)
     )
 
 
@@ -444,18 +461,14 @@ async def delete_program_callback(callback: CallbackQuery):
     Обработчик удаления программы.
     """
     await callback.answer()
-    program_id = int(callback.data.split("_")[-1])
+    program_id = int(callback.data.rpartition("_")[2])
     user_id = callback.from_user.id
     
     # Удаляем программу
-    delete_workout_program(user_id, program_id)
+    await asyncio.to_thread(delete_workout_program, user_id, program_id)
     
     await callback.message.answer("✅ Программа удалена!")
     
-    # Обновляем список программ
-    programs = get_user_programs(user_id)
-    has_programs = len(programs) > 0
-    
     await callback.message.answer(
         "Выбери режим работы:",
         reply_markup=get_mode_selection_keyboard()
@@ -1,6 +1,8 @@
 """
 Обработчик команды /stats для просмотра статистики тренировок.
 """
+import asyncio
+
 from aiogram import Router
 from aiogram.types import Message
 from aiogram.filters import Command
@@ -18,7 +20,7 @@ async def cmd_stats(message: Message):
     user_id = message.from_user.id
     
     # Получаем статистику
-    stats = get_stats(user_id)
+    stats = await asyncio.to_thread(get_stats, user_id)
     
     if not stats:
         await message.answer(
@@ -27,10 +29,10 @@ async def cmd_stats(message: Message):
         )
         return
     
-    # Форматируем статистику
-    stats_text = "📊 Твоя статистика:\n\n"
-    for exercise, max_weight in sorted(stats.items()):
-        stats_text += f"💪 {exercise} — {max_weight} кг\n"
+    # Форматируем статистику (упражнения уже отсортированы запросом)
+    lines = ["📊 Твоя статистика:", ""]
+    for exercise, max_weight in stats.items():
+        lines.append(f"💪 {exercise} — {max_weight} кг")
     
-    await message.answer(stats_text)
+    await message.answer("\n".join(lines) + "\n")
 
@@ -2,18 +2,22 @@
 Обработчик тренировок.
 Управляет процессом тренировки с использованием FSM (Finite State Machine).
 """
+import asyncio
+
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from database import (
-    get_program, save_result, get_last_weight, get_program_by_id,
-    create_workout_session, add_workout_exercise, add_exercise_set,
-    save_set_weight, get_current_set_id
+    get_program, save_result, get_last_weight, get_last_weights, get_program_by_id,
+    create_workout_session, add_workout_exercises,
+    save_set_weight, get_current_set_id, flush_results
 )
 from utils.keyboards import get_training_control_keyboard, get_confirm_keyboard
-from utils.helpers import format_training_exercises
-import database
+from utils.helpers import format_training_exercises, WEIGHT_RE
+from utils.sessions import SessionStore
+from parser import get_current_day
+from handlers.button_workouts import button_training_sessions
 
 router = Router()
 
@@ -24,9 +28,9 @@ class TrainingState(StatesGroup):
     confirming_weight = State()   # Подтверждение веса
 
 
-# Хранилище текущих тренировок пользователей
+# Хранилище текущих тренировок пользователей (брошенные удаляются через 2 часа)
 # Формат: {user_id: {'workout_id': ID, 'day': день, 'exercises': [...], 'current_ex': индекс, 'current_set': номер, 'program_id': ID}}
-training_sessions = {}
+training_sessions = SessionStore(ttl=2 * 60 * 60)
 
 
 async def start_training_session(message: Message, day: str = None):
@@ -37,15 +41,13 @@ async def start_training_session(message: Message, day: str = None):
         message: Сообщение от пользователя
         day: День недели (если None, определяется автоматически)
     """
-    from parser import get_current_day
-    
     user_id = message.from_user.id
     
     if day is None:
         day = get_current_day()
     
     # Получаем программу на этот день
-    program = get_program(user_id, day)
+    program = await asyncio.to_thread(get_program, user_id, day)
     
     if not program or day not in program:
         await message.answer(
@@ -64,6 +66,12 @@ async def start_training_session(message: Message, day: str = None):
         'current_set': 1
     }
     
+    # Последние веса всех подходов одним запросом: дальше get_last_weight берет их из кэша
+    await asyncio.to_thread(
+        get_last_weights, user_id,
+        [(ex['exercise'], n) for ex in exercises for n in range(1, ex['sets'] + 1)]
+    )
+    
     # Отправляем список упражнений
     exercises_text = format_training_exercises(day, exercises)
     await message.answer(
@@ -95,7 +103,7 @@ async def ask_for_weight(message: Message, user_id: int):
     set_number = session['current_set']
     
     # Проверяем, есть ли предыдущий вес
-    last_weight = get_last_weight(user_id, exercise_name, set_number)
+    last_weight = await asyncio.to_thread(get_last_weight, user_id, exercise_name, set_number)
     
     if last_weight:
         # Предлагаем предыдущий вес
@@ -113,35 +121,6 @@ async def ask_for_weight(message: Message, user_id: int):
         )
 
 
-@router.callback_query(F.data == "save_program")
-async def save_program_callback(callback: CallbackQuery):
-    """
-    Обработчик кнопки "Сохранить программу".
-    Сохраняет распарсенную программу в базу данных.
-    """
-    user_id = callback.from_user.id
-    
-    # Получаем временно сохраненную программу
-    if not hasattr(database, 'temp_programs') or user_id not in database.temp_programs:
-        await callback.answer("❌ Программа не найдена. Отправь программу заново.", show_alert=True)
-        return
-    
-    program = database.temp_programs[user_id]
-    
-    # Сохраняем в базу
-    from database import save_program
-    save_program(user_id, program)
-    
-    # Удаляем из временного хранилища
-    del database.temp_programs[user_id]
-    
-    await callback.answer("✅ Программа сохранена!", show_alert=True)
-    await callback.message.edit_text(
-        callback.message.text + "\n\n✅ Программа сохранена!",
-        reply_markup=None
-    )
-
-
 @router.callback_query(F.data == "end_training")
 async def end_training_callback(callback: CallbackQuery):
     """
@@ -151,13 +130,13 @@ async def end_training_callback(callback: CallbackQuery):
     user_id = callback.from_user.id
     
     # Проверяем, есть ли активная тренировка по кнопкам
-    from handlers.button_workouts import button_training_sessions
     if user_id in button_training_sessions:
         # Обрабатывается в button_workouts.py
         return
     
     if user_id in training_sessions:
         del training_sessions[user_id]
+        await asyncio.to_thread(flush_results)
     
     await callback.answer("Тренировка завершена!", show_alert=True)
     await callback.message.answer("✅ Тренировка завершена! Отличная работа! 💪")
@@ -172,7 +151,6 @@ async def confirm_weight_callback(callback: CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     
     # Проверяем, есть ли активная тренировка по кнопкам
-    from handlers.button_workouts import button_training_sessions
     if user_id in button_training_sessions:
         # Обрабатывается в button_workouts.py
         return
@@ -190,20 +168,20 @@ async def confirm_weight_callback(callback: CallbackQuery, state: FSMContext):
     
     if workout_id:
         # Используем новую структуру с Workout ID -> Exercise ID -> Set ID -> Weight ID
-        set_id = get_current_set_id(workout_id, session['current_ex'], set_number)
+        set_id = await asyncio.to_thread(get_current_set_id, workout_id, session['current_ex'], set_number)
         if not set_id:
             await callback.answer("❌ Ошибка: ID подхода не найден", show_alert=True)
             return
         
         # Получаем последний вес (из старой структуры для обратной совместимости)
-        last_weight = get_last_weight(user_id, exercise_name, set_number)
+        last_weight = await asyncio.to_thread(get_last_weight, user_id, exercise_name, set_number)
         
         if not last_weight:
             await callback.answer("❌ Предыдущий вес не найден", show_alert=True)
             return
         
         # Сохраняем вес через новую структуру (Weight ID)
-        save_set_weight(set_id, last_weight)
+        await asyncio.to_thread(save_set_weight, set_id, last_weight)
     else:
         # Обратная совместимость со старой структурой
         exercise_id = exercise.get('exercise_id')
@@ -212,14 +190,14 @@ async def confirm_weight_callback(callback: CallbackQuery, state: FSMContext):
             return
         
         # Получаем последний вес
-        last_weight = get_last_weight(user_id, exercise_name, set_number)
+        last_weight = await asyncio.to_thread(get_last_weight, user_id, exercise_name, set_number)
         
         if not last_weight:
             await callback.answer("❌ Предыдущий вес не найден", show_alert=True)
             return
         
         # Сохраняем вес
-        save_result(user_id, exercise_id, session['day'], exercise_name, set_number, last_weight)
+        await asyncio.to_thread(save_result, user_id, exercise_id, session['day'], exercise_name, set_number, last_weight)
     
     await callback.answer(f"✅ Сохранено: {last_weight} кг")
     
@@ -267,20 +245,20 @@ async def process_weight_input(message: Message, state: FSMContext):
     
     if workout_id:
         # Используем новую структуру с Workout ID -> Exercise ID -> Set ID -> Weight ID
-        set_id = get_current_set_id(workout_id, session['current_ex'], set_number)
+        set_id = await asyncio.to_thread(get_current_set_id, workout_id, session['current_ex'], set_number)
         if not set_id:
             await message.answer("❌ Ошибка: ID подхода не найден")
             return
         
         # Сохраняем вес через новую структуру (Weight ID)
-        save_set_weight(set_id, weight)
+        await asyncio.to_thread(save_set_weight, set_id, weight)
     else:
         # Обратная совместимость со старой структурой
         exercise_id = exercise.get('exercise_id')
         if not exercise_id:
             await message.answer("❌ Ошибка: ID упражнения не найден")
             return
-        save_result(user_id, exercise_id, session['day'], exercise_name, set_number, weight)
+        await asyncio.to_thread(save_result, user_id, exercise_id, session['day'], exercise_name, set_number, weight)
     
     await message.answer(f"✅ Сохранено: {weight} кг")
     
@@ -289,7 +267,7 @@ async def process_weight_input(message: Message, state: FSMContext):
     await state.clear()
 
 
-@router.message(F.text.regexp(r'^\d+([.,]\d+)?$') & ~F.text.startswith('/'))
+@router.message(F.text.regexp(WEIGHT_RE))
 async def process_weight_direct(message: Message, state: FSMContext):
     """
     Обработчик прямого ввода веса (без состояния FSM).
@@ -299,7 +277,6 @@ async def process_weight_direct(message: Message, state: FSMContext):
     user_id = message.from_user.id
     
     # Проверяем, есть ли активная тренировка по кнопкам
-    from handlers.button_workouts import button_training_sessions
     if user_id in button_training_sessions:
         # Вес обработается в button_workouts.py
         return
@@ -315,12 +292,9 @@ async def process_weight_direct(message: Message, state: FSMContext):
     if current_state == TrainingState.waiting_for_weight:
         return
     
-    # Парсим вес
-    try:
-        weight = float(message.text.replace(',', '.'))
-        if weight <= 0:
-            return
-    except ValueError:
+    # Парсим вес: формат числа уже проверен фильтром WEIGHT_RE
+    weight = float(message.text.replace(',', '.'))
+    if weight <= 0:
         return
     
     exercise = session['exercises'][session['current_ex']]
@@ -330,20 +304,20 @@ async def process_weight_direct(message: Message, state: FSMContext):
     
     if workout_id:
         # Используем новую структуру с Workout ID -> Exercise ID -> Set ID -> Weight ID
-        set_id = get_current_set_id(workout_id, session['current_ex'], set_number)
+        set_id = await asyncio.to_thread(get_current_set_id, workout_id, session['current_ex'], set_number)
         if not set_id:
             await message.answer("❌ Ошибка: ID подхода не найден")
             return
         
         # Сохраняем вес через новую структуру (Weight ID)
-        save_set_weight(set_id, weight)
+        await asyncio.to_thread(save_set_weight, set_id, weight)
     else:
         # Обратная совместимость со старой структурой
         exercise_id = exercise.get('exercise_id')
         if not exercise_id:
             await message.answer("❌ Ошибка: ID упражнения не найден")
             return
-        save_result(user_id, exercise_id, session['day'], exercise_name, set_number, weight)
+        await asyncio.to_thread(save_result, user_id, exercise_id, session['day'], exercise_name, set_number, weight)
     
     await message.answer(f"✅ Сохранено: {weight} кг")
     
@@ -384,6 +358,7 @@ async def move_to_next_set(message: Message, user_id: int):
         else:
             # Все упражнения завершены
             del training_sessions[user_id]
+            await asyncio.to_thread(flush_results)
             await message.answer(
                 "🎉 Тренировка завершена! Отличная работа! 💪\n\n"
                 "Все результаты сохранены. Используй /stats для просмотра статистики."
@@ -398,19 +373,17 @@ async def start_training_session_with_program(message: Message, program_id: int)
         message: Сообщение от пользователя
         program_id: ID программы
     """
-    from parser import get_current_day
-    
     user_id = message.from_user.id
     
     # Определяем текущий день
     day = get_current_day()
     
     # Получаем программу по ID для конкретного дня
-    program = get_program_by_id(user_id, program_id, day=day)
+    program = await asyncio.to_thread(get_program_by_id, user_id, program_id, day=day)
     
     if not program:
         # Если программа не найдена для этого дня, получаем все дни для показа списка
-        all_program = get_program_by_id(user_id, program_id)
+        all_program = await asyncio.to_thread(get_program_by_id, user_id, program_id)
         if not all_program:
             await message.answer("❌ Программа не найдена.")
             return
@@ -424,23 +397,13 @@ async def start_training_session_with_program(message: Message, program_id: int)
         )
         return
     
-    # Получаем упражнения для текущего дня
-    # Убеждаемся, что используем список в правильном порядке
-    # Важно: program - это OrderedDict, поэтому порядок сохраняется
+    # Получаем упражнения для текущего дня: get_program_by_id возвращает
+    # собственную копию, уже отсортированную по order_index
     exercises = program.get(day, [])
-    # Создаем новый список, чтобы гарантировать сохранение порядка
-    # Сортируем по order_index, если он есть, для гарантии правильного порядка
-    if exercises:
-        exercises = list(exercises)  # Копируем список
-        # Если у упражнений есть order_index, сортируем по нему
-        if exercises and 'order_index' in exercises[0]:
-            exercises.sort(key=lambda x: x.get('order_index', 0))
-    else:
-        exercises = []
     
     if not exercises:
         # Если упражнения не найдены, показываем список доступных дней
-        all_program = get_program_by_id(user_id, program_id)
+        all_program = await asyncio.to_thread(get_program_by_id, user_id, program_id)
         if all_program:
             days_list = "\n".join([f"• {d}" for d in all_program.keys()])
             await message.answer(
@@ -453,50 +416,31 @@ async def start_training_session_with_program(message: Message, program_id: int)
         return
     
     # Создаем сессию тренировки (Workout ID)
-    workout_id = create_workout_session(user_id, program_id=program_id, day=day)
-    
-    # Добавляем упражнения в тренировку в правильном порядке (Exercise ID)
-    # ВАЖНО: используем явную итерацию по списку, чтобы гарантировать порядок
-    exercise_ids = []
-    # Создаем копию списка для гарантии порядка
-    exercises_list = list(exercises) if isinstance(exercises, list) else list(exercises)
-    
-    for order_index, exercise_data in enumerate(exercises_list):
-        exercise_template_id = exercise_data.get('exercise_id')
-        exercise_name = exercise_data['exercise']
-        sets_count = exercise_data['sets']
-        
-        # Создаем упражнение в тренировке с явным order_index
-        exercise_id = add_workout_exercise(
-            workout_id=workout_id,
-            exercise_template_id=exercise_template_id,
-            exercise_name=exercise_name,
-            order_index=order_index  # Явно указываем порядок
-        )
-        exercise_ids.append(exercise_id)
-        
-        # Добавляем подходы для этого упражнения в правильном порядке (Set ID)
-        for set_num in range(1, sets_count + 1):
-            add_exercise_set(
-                exercise_id=exercise_id,
-                set_number=set_num,
-                order_index=set_num - 1  # Явно указываем порядок
-            )
+    workout_id = await asyncio.to_thread(create_workout_session, user_id, program_id=program_id, day=day)
+    
+    # Добавляем упражнения (Exercise ID) и их подходы (Set ID) в правильном порядке
+    # одним пакетом: order_index задается позицией в списке
+    exercise_ids = await asyncio.to_thread(add_workout_exercises, workout_id, exercises)
     
     # Сохраняем сессию тренировки
-    # ВАЖНО: используем exercises_list для сохранения правильного порядка
     training_sessions[user_id] = {
         'workout_id': workout_id,  # Workout ID
         'day': day,
-        'exercises': exercises_list,  # Используем список в правильном порядке
+        'exercises': exercises,
         'exercise_ids': exercise_ids,  # Exercise IDs в порядке
         'current_ex': 0,
         'current_set': 1,
         'program_id': program_id
     }
     
+    # Последние веса всех подходов одним запросом: дальше get_last_weight берет их из кэша
+    await asyncio.to_thread(
+        get_last_weights, user_id,
+        [(ex['exercise'], n) for ex in exercises for n in range(1, ex['sets'] + 1)]
+    )
+    
     # Отправляем список упражнений
-    exercises_text = format_training_exercises(day, exercises_list)
+    exercises_text = format_training_exercises(day, exercises)
     await message.answer(
         f"{exercises_text}\n"
         "Начинаем тренировку! После каждого подхода отправь вес в кг (например: 60).",
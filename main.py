@@ -7,6 +7,8 @@ import asyncio
 import logging
 import sys
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 # Добавляем текущую директорию и родительскую в путь для импортов
@@ -16,10 +18,13 @@ parent_dir = current_dir.parent.absolute()
 working_dir = Path(os.getcwd()).absolute()
 
 # Добавляем пути в sys.path (если их там еще нет)
-# Порядок важен: сначала текущая директория файла, затем рабочая, затем родительская
-for path in [str(current_dir), str(working_dir), str(parent_dir)]:
-    if path and path not in sys.path:
-        sys.path.insert(0, path)
+# Порядок важен: директория файла - первой, рабочая и родительская - в самый конец,
+# чтобы они не перекрывали модули проекта и просматривались только при промахе импорта
+if str(current_dir) not in sys.path:
+    sys.path.insert(0, str(current_dir))
+for path in (str(working_dir), str(parent_dir)):
+    if path not in sys.path:
+        sys.path.append(path)
 
 # Настройка логирования (до импортов, чтобы видеть возможные ошибки)
 logging.basicConfig(
@@ -27,12 +32,22 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+# Подробные логи запуска (пути импорта) включаются переменной DEBUG_STARTUP=1
+if os.environ.get("DEBUG_STARTUP") == "1":
+    logger.setLevel(logging.DEBUG)
 
-# Логируем пути для отладки
-logger.info(f"Текущая директория файла: {current_dir}")
-logger.info(f"Рабочая директория: {working_dir}")
-logger.info(f"Родительская директория: {parent_dir}")
-logger.info(f"Python path (первые 5): {sys.path[:5]}")
+# Интервал обслуживания базы данных, секунд
+DB_MAINTENANCE_INTERVAL = 15 * 60
+# Интервал сброса накопленных результатов подходов в базу, секунд
+RESULTS_FLUSH_INTERVAL = 60
+# Сколько отдавать /status из кэша, не спрашивая Telegram заново, секунд
+STATUS_CACHE_TTL = 10
+
+# Логируем пути для отладки (форматирование откладывается до реального вывода)
+logger.debug("Текущая директория файла: %s", current_dir)
+logger.debug("Рабочая директория: %s", working_dir)
+logger.debug("Родительская директория: %s", parent_dir)
+logger.debug("Python path (первые 5): %s", sys.path[:5])
 
 try:
     from aiogram import Bot, Dispatcher
@@ -41,24 +56,63 @@ try:
     from aiohttp import web
     from aiohttp.web import run_app
     from config import BOT_TOKEN, WEBHOOK_URL, WEBHOOK_PORT, WEBHOOK_PATH
-    from database import init_db
-    from handlers import start, training, stats, button_workouts
+    from database import init_db, maintenance, flush_results
 except ImportError as e:
     logger.error(f"Ошибка импорта: {e}")
     logger.error(f"Текущая рабочая директория: {os.getcwd()}")
     logger.error(f"Содержимое текущей директории: {list(current_dir.iterdir())}")
     raise
 
+# Путь webhook без лишних слешей (пустой путь заменяем на "webhook") и полный адрес.
+# Считаем один раз: регистрация обработчика, set_webhook и логи должны совпадать
+WEBHOOK_PATH_NORMALIZED = "/" + (WEBHOOK_PATH.strip('/') or "webhook")
+WEBHOOK_FULL_URL = f"{(WEBHOOK_URL or '').rstrip('/')}{WEBHOOK_PATH_NORMALIZED}"
+
+# uvloop быстрее стандартного цикла событий; под Windows его нет - работаем на asyncio
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+def import_handlers():
+    """
+    Импортирует модули обработчиков.
+    Вызывается из main, пока в соседнем потоке идет init_db.
+    
+    Returns:
+        Модули (button_workouts, training, stats, start)
+    """
+    try:
+        from handlers import start, training, stats, button_workouts
+    except ImportError as e:
+        logger.error(f"Ошибка импорта: {e}")
+        logger.error(f"Текущая рабочая директория: {os.getcwd()}")
+        logger.error(f"Содержимое текущей директории: {list(current_dir.iterdir())}")
+        raise
+    return button_workouts, training, stats, start
+
 
 def main():
     """
     Главная функция для запуска бота.
     Поддерживает как polling (для локальной разработки), так и webhook (для продакшена).
     """
-    # Инициализируем базу данных (синхронная операция)
+    # Политика цикла событий действует и на asyncio.run (polling), и на run_app (webhook)
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("Цикл событий: uvloop")
+    
+    # Инициализируем базу данных (синхронная операция) в отдельном потоке:
+    # sqlite3 отпускает GIL на время работы с диском, и импорт обработчиков,
+    # настройка бота и (для webhook) set_webhook идут параллельно, сокращая холодный старт.
+    # Дожидаемся db_ready до приема первых обновлений
     logger.info("Инициализация базы данных...")
-    init_db()
-    logger.info("База данных инициализирована")
+    executor = ThreadPoolExecutor(max_workers=1)
+    db_ready = executor.submit(init_db)
+    button_workouts, training, stats, start = import_handlers()
+    # Поток сам завершится после init_db, блокироваться на нем здесь не нужно
+    executor.shutdown(wait=False)
     
     # Создаем бота и диспетчер
     bot = Bot(token=BOT_TOKEN)
@@ -72,6 +126,40 @@ def main():
     dp.include_router(stats.router)
     dp.include_router(start.router)  # В конце, так как содержит общий обработчик текста
     
+    # Периодическое обслуживание БД в фоне: сброс буфера результатов (на случай
+    # незавершенных тренировок) и PRAGMA optimize + checkpoint WAL
+    async def db_maintenance_loop():
+        elapsed = 0
+        while True:
+            await asyncio.sleep(RESULTS_FLUSH_INTERVAL)
+            elapsed += RESULTS_FLUSH_INTERVAL
+            try:
+                if elapsed >= DB_MAINTENANCE_INTERVAL:
+                    elapsed = 0
+                    await asyncio.to_thread(maintenance)
+                else:
+                    await asyncio.to_thread(flush_results)
+            except Exception as e:
+                logger.error(f"Ошибка обслуживания базы данных: {e}", exc_info=True)
+    
+    maintenance_tasks = []
+    
+    # Python 3.12+: задачи обработчиков выполняются сразу до первого реального ожидания,
+    # поэтому короткие обработчики (ответ из кэша, callback.answer) не ждут планировщика
+    @dp.startup()
+    async def enable_eager_tasks():
+        if hasattr(asyncio, 'eager_task_factory'):
+            asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+    
+    @dp.startup()
+    async def start_db_maintenance():
+        maintenance_tasks.append(asyncio.create_task(db_maintenance_loop()))
+    
+    @dp.shutdown()
+    async def stop_db_maintenance():
+        for task in maintenance_tasks:
+            task.cancel()
+    
     # Если указан WEBHOOK_URL, используем webhook (для продакшена)
     if WEBHOOK_URL:
         logger.info("Запуск в режиме webhook...")
@@ -83,31 +171,19 @@ def main():
         app = web.Application()
         
         # Настраиваем обработчик webhook
-        # Убираем лишние слеши из пути
-        webhook_path_clean = WEBHOOK_PATH.strip('/')
-        if not webhook_path_clean:
-            webhook_path_clean = "webhook"
-        webhook_path_final = f"/{webhook_path_clean}"
-        
         webhook_requests_handler = SimpleRequestHandler(
             dispatcher=dp,
             bot=bot,
         )
-        webhook_requests_handler.register(app, path=webhook_path_final)
-        logger.info(f"Webhook handler зарегистрирован на пути: {webhook_path_final}")
+        webhook_requests_handler.register(app, path=WEBHOOK_PATH_NORMALIZED)
+        logger.info(f"Webhook handler зарегистрирован на пути: {WEBHOOK_PATH_NORMALIZED}")
         
         # Настраиваем startup и shutdown для webhook
         async def on_startup(app):
-            # Убираем лишние слеши из URL
-            webhook_base = WEBHOOK_URL.rstrip('/')
-            webhook_path_clean = WEBHOOK_PATH.strip('/')
-            if not webhook_path_clean:
-                webhook_path_clean = "webhook"
-            webhook_url = f"{webhook_base}/{webhook_path_clean}"
-            logger.info(f"Устанавливаем webhook: {webhook_url}")
+            logger.info(f"Устанавливаем webhook: {WEBHOOK_FULL_URL}")
             try:
-                await bot.set_webhook(webhook_url, drop_pending_updates=True)
-                logger.info(f"✅ Webhook успешно установлен: {webhook_url}")
+                await bot.set_webhook(WEBHOOK_FULL_URL, drop_pending_updates=True)
+                logger.info(f"✅ Webhook успешно установлен: {WEBHOOK_FULL_URL}")
                 
                 # Проверяем установленный webhook
                 webhook_info = await bot.get_webhook_info()
@@ -115,6 +191,11 @@ def main():
             except Exception as e:
                 logger.error(f"❌ Ошибка при установке webhook: {e}", exc_info=True)
                 raise  # Пробрасываем ошибку, чтобы сервер не запустился с неработающим webhook
+            
+            # aiohttp открывает порт только после on_startup, поэтому
+            # обновления не придут раньше готовности базы
+            await asyncio.wrap_future(db_ready)
+            logger.info("База данных инициализирована")
         
         async def on_shutdown(app):
             logger.info("Shutdown handler вызван (webhook остается активным)...")
@@ -142,14 +223,22 @@ def main():
         
         # Добавляем простой обработчик для корневого пути (чтобы не было 404)
         async def root_handler(request):
-            return web.Response(text="Bot is running! Webhook path: " + WEBHOOK_PATH, status=200)
+            return web.Response(text="Bot is running! Webhook path: " + WEBHOOK_PATH_NORMALIZED, status=200)
         
         app.router.add_get("/", root_handler)
         
         # Добавляем обработчик для проверки статуса webhook
+        # Ответ Telegram кэшируется: частые проверки мониторинга не тратят лимиты Bot API
+        webhook_info_cache = {'time': 0.0, 'info': None}
+        
         async def status_handler(request):
             try:
-                webhook_info = await bot.get_webhook_info()
+                now = time.monotonic()
+                webhook_info = webhook_info_cache['info']
+                if webhook_info is None or now - webhook_info_cache['time'] >= STATUS_CACHE_TTL:
+                    webhook_info = await bot.get_webhook_info()
+                    webhook_info_cache['info'] = webhook_info
+                    webhook_info_cache['time'] = now
                 status_text = f"Bot Status:\nWebhook URL: {webhook_info.url}\nPending updates: {webhook_info.pending_update_count}\nLast error: {webhook_info.last_error_message}"
                 return web.Response(text=status_text, status=200)
             except Exception as e:
@@ -162,12 +251,9 @@ def main():
         
         # Запускаем веб-сервер (синхронная функция, блокирующая)
         # Соединения будут закрыты автоматически через cleanup_context
-        webhook_base = WEBHOOK_URL.rstrip('/')
-        webhook_path = WEBHOOK_PATH.lstrip('/')
-        final_webhook_url = f"{webhook_base}/{webhook_path}"
         logger.info(f"Веб-сервер запущен на порту {WEBHOOK_PORT}")
-        logger.info(f"Ожидаем обновления на: {final_webhook_url}")
-        logger.info(f"Webhook handler зарегистрирован на пути: /{webhook_path}")
+        logger.info(f"Ожидаем обновления на: {WEBHOOK_FULL_URL}")
+        logger.info(f"Webhook handler зарегистрирован на пути: {WEBHOOK_PATH_NORMALIZED}")
         run_app(app, host="0.0.0.0", port=WEBHOOK_PORT)
     else:
         # Используем polling (для локальной разработки)
@@ -175,13 +261,11 @@ def main():
         logger.info("⚠️  ВНИМАНИЕ: Убедитесь, что бот не запущен в другом месте!")
         logger.info("⚠️  Для продакшена установите переменную WEBHOOK_URL")
         
-        async def run_polling():
-            try:
-                await dp.start_polling(bot, skip_updates=True)
-            finally:
-                await bot.session.close()
+        db_ready.result()
+        logger.info("База данных инициализирована")
         
-        asyncio.run(run_polling())
+        # start_polling сам закрывает сессию бота при остановке (close_bot_session=True)
+        asyncio.run(dp.start_polling(bot, skip_updates=True))
 
 
 if __name__ == "__main__":
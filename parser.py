@@ -6,8 +6,9 @@
 - Гакк-присед — 20-16-14-12 (увеличивая вес)
 """
 import re
-from collections import OrderedDict
-from typing import Dict, List, Optional
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 
 # Маппинг дней недели (русские сокращения -> полные названия)
 DAY_MAPPING = {
@@ -27,10 +28,55 @@ DAY_MAPPING = {
     'ВОСКРЕСЕНЬЕ': 'Воскресенье'
 }
 
+# Дни недели по номеру datetime.weekday() (0 = понедельник)
+_WEEKDAYS = (
+    'Понедельник', 'Вторник', 'Среда', 'Четверг',
+    'Пятница', 'Суббота', 'Воскресенье'
+)
 
+# Названия дней для быстрой проверки начала строки (str.startswith принимает кортеж)
+_DAY_KEYS = tuple(DAY_MAPPING)
+_DAY_KEY_MAX_LEN = max(map(len, DAY_MAPPING))
+
+# Регулярные выражения компилируются один раз при импорте модуля
+# Эмодзи и маркеры списка: удаляются где угодно в строке (str.translate) и срезаются
+# в ее начале вместе с дефисами и пробелами (str.lstrip) - без прохода движка регулярок
+_DECOR_CHARS = '🔹🔸▪▫•\ufe0f'
+_DECOR_TABLE = str.maketrans('', '', _DECOR_CHARS)
+# Все пробельные символы Unicode (как \s в регулярках) лежат ниже U+3001
+_LEADING_DECOR_CHARS = _DECOR_CHARS + '-' + ''.join(
+    char for char in map(chr, range(0x3001)) if char.isspace()
+)
+# Первый символ (в верхнем регистре), с которого может начинаться заголовок дня
+_DAY_HEADER_START = frozenset(_DECOR_CHARS) | frozenset(key[0] for key in DAY_MAPPING)
+# День недели в начале строки: "ПН:" или "ПН —", "ПТ Ноги", просто "ПТ"
+_DAY_RE = re.compile(r'^([А-ЯЁ]{2,})(?:\s*[:—\-]|\s+|$)', re.IGNORECASE)
+# Старый формат "ПН: упражнение1, упражнение2"
+_DAY_PREFIX_RE = re.compile(r'^([А-ЯЁ]+)\s*[:—\-]', re.IGNORECASE)
+# Комментарии в скобках
+_PARENS_RE = re.compile(r'\([^)]*\)')
+# "3 подхода", "1 подходов"
+_SETS_WORD_RE = re.compile(r'(\d+)\s+подход(?:ов)?', re.IGNORECASE)
+# "4х10" или "4x10": подходы x повторения
+_SETS_X_REPS_RE = re.compile(r'(\d+)\s*[хx]\s*(\d+)', re.IGNORECASE)
+_NUMBER_RE = re.compile(r'\d+')
+_DASH_PAIR_RE = re.compile(r'\d+-\d+')
+# Разделители названия и подходов в порядке приоритета
+_EXERCISE_SEPARATORS = ('—', '–', '-')
+# Строка без разделителя, один проход вместо двух шаблонов подряд:
+# name/sets - название, пробел, затем подходы; иначе tail_name/tail_sets - подходы
+# в конце строки (ленивый префикс перебирает позиции слева направо, как search)
+_NAME_AND_SETS_RE = re.compile(
+    r'^(?:(?P<name>.+?)\s+(?P<sets>\d+[хx]\d+|\d+-\d+.*|\d+)'
+    r'|(?P<tail_name>(?s:.*?))(?P<tail_sets>\d+[хx]\d+|\d+-\d+.*|\d+)\s*$)'
+)
+
+
+@lru_cache(maxsize=4096)
 def extract_day_from_text(text: str) -> Optional[str]:
     """
     Извлекает день недели из текста.
+    Результат кэшируется: пользователи присылают одни и те же строки программ повторно.
     Поддерживает форматы:
     - "ПН:" или "ПН "
     - "🔹 ПТ Ноги"
@@ -40,23 +86,18 @@ def extract_day_from_text(text: str) -> Optional[str]:
         Полное название дня недели или None
     """
     # Убираем эмодзи и специальные символы
-    text_clean = re.sub(r'[🔹🔸▪️▫️•]', '', text).strip()
+    text_clean = text.translate(_DECOR_TABLE).strip()
+    
+    # Большинство строк - упражнения: если строка не начинается с названия дня,
+    # регулярные выражения не нужны
+    if not text_clean[:_DAY_KEY_MAX_LEN].upper().startswith(_DAY_KEYS):
+        return None
     
     # Ищем день недели в начале строки
     # Формат: "ПН:", "ПН ", "ПТ Ноги"
-    patterns = [
-        r'^([А-ЯЁ]{2,})\s*[:—\-]',  # "ПН:" или "ПН —"
-        r'^([А-ЯЁ]{2,})\s+',         # "ПТ Ноги"
-        r'^([А-ЯЁ]{2,})$',           # Просто "ПТ"
-    ]
-    
-    for pattern in patterns:
-        match = re.match(pattern, text_clean, re.IGNORECASE)
-        if match:
-            day_short = match.group(1).upper()
-            day_full = DAY_MAPPING.get(day_short)
-            if day_full:
-                return day_full
+    match = _DAY_RE.match(text_clean)
+    if match:
+        return DAY_MAPPING.get(match.group(1).upper())
     
     return None
 
@@ -81,33 +122,43 @@ def parse_sets_from_exercise(exercise_text: str) -> int:
         Количество подходов
     """
     # Убираем комментарии в скобках
-    exercise_text = re.sub(r'\([^)]*\)', '', exercise_text).strip()
+    exercise_text = _PARENS_RE.sub('', exercise_text).strip()
     
     # Формат "X подходов" или "X подход" (например: "1 подходов", "3 подход")
-    match = re.search(r'(\d+)\s+подход(?:ов)?', exercise_text, re.IGNORECASE)
+    match = _SETS_WORD_RE.search(exercise_text)
     if match:
         return int(match.group(1))
     
     # Формат "4х10" или "4x10" (подходы x повторения)
-    match = re.search(r'(\d+)\s*[хx]\s*\d+', exercise_text, re.IGNORECASE)
+    match = _SETS_X_REPS_RE.search(exercise_text)
     if match:
         return int(match.group(1))
     
     # Формат "20-16-14-12" (диапазоны повторений)
-    # Считаем количество чисел, разделенных дефисами
-    ranges = re.findall(r'\d+', exercise_text)
-    if ranges and len(ranges) >= 2:
-        # Если есть несколько чисел через дефис, это количество подходов
-        dash_separated = re.findall(r'\d+-\d+', exercise_text)
-        if dash_separated:
-            # Считаем все числа в диапазонах
-            all_numbers = re.findall(r'\d+', exercise_text)
-            return len(all_numbers)
+    # Если есть несколько чисел и хотя бы пара через дефис - количество чисел и есть подходы
+    numbers = _NUMBER_RE.findall(exercise_text)
+    if len(numbers) >= 2 and '-' in exercise_text and _DASH_PAIR_RE.search(exercise_text):
+        return len(numbers)
     
     # Если ничего не найдено, возвращаем 1 подход по умолчанию
     return 1
 
 
+def _split_name_and_sets(line: str) -> Optional[Tuple[str, str]]:
+    """
+    Делит строку без разделителя на название упражнения и описание подходов.
+    
+    Returns:
+        Кортеж (название, описание подходов) или None, если чисел подходов нет
+    """
+    match = _NAME_AND_SETS_RE.match(line)
+    if not match:
+        return None
+    if match.group('sets') is not None:
+        return match.group('name').strip(), match.group('sets').strip()
+    return match.group('tail_name').strip(), match.group('tail_sets').strip()
+
+
 def parse_exercise_with_reps(line: str) -> Optional[Dict]:
     """
     Парсит строку с упражнением и извлекает повторения для каждого подхода.
@@ -128,45 +179,35 @@ def parse_exercise_with_reps(line: str) -> Optional[Dict]:
         return None
     
     # Убираем эмодзи и специальные символы в начале
-    line = re.sub(r'^[🔹🔸▪️▫️•\-\s]+', '', line).strip()
+    line = line.lstrip(_LEADING_DECOR_CHARS).strip()
     
     # Разделяем название упражнения и описание подходов
-    separators = ['—', '–', '-']
     exercise_name = line
     sets_description = ""
     
-    for sep in separators:
-        if sep in line:
-            parts = line.split(sep, 1)
-            if len(parts) == 2:
-                exercise_name = parts[0].strip()
-                sets_description = parts[1].strip()
-                break
+    for sep in _EXERCISE_SEPARATORS:
+        name, found, rest = line.partition(sep)
+        if found:
+            exercise_name = name.strip()
+            sets_description = rest.strip()
+            break
     
     # Если разделитель не найден, ищем паттерн с числами
     if not sets_description:
-        match = re.match(r'^(.+?)\s+(\d+[хx]\d+|\d+-\d+.*|\d+)', line)
-        if match:
-            exercise_name = match.group(1).strip()
-            sets_description = match.group(2).strip()
-    
-    if not sets_description:
-        match = re.search(r'(\d+[хx]\d+|\d+-\d+.*|\d+)\s*$', line)
-        if match:
-            num_start = match.start()
-            exercise_name = line[:num_start].strip()
-            sets_description = match.group(1).strip()
+        split = _split_name_and_sets(line)
+        if split:
+            exercise_name, sets_description = split
     
     if not exercise_name:
         return None
     
     # Убираем комментарии в скобках
-    sets_description_clean = re.sub(r'\([^)]*\)', '', sets_description).strip()
+    sets_description_clean = _PARENS_RE.sub('', sets_description).strip()
     
     sets_list = []
     
     # Формат "4х10" или "4x10" (подходы x повторения)
-    match = re.search(r'(\d+)\s*[хx]\s*(\d+)', sets_description_clean, re.IGNORECASE)
+    match = _SETS_X_REPS_RE.search(sets_description_clean)
     if match:
         num_sets = int(match.group(1))
         reps = int(match.group(2))
@@ -174,7 +215,7 @@ def parse_exercise_with_reps(line: str) -> Optional[Dict]:
             sets_list.append({'set_number': i, 'reps': reps})
     else:
         # Формат "20-16-14-12" (диапазоны повторений)
-        numbers = re.findall(r'\d+', sets_description_clean)
+        numbers = _NUMBER_RE.findall(sets_description_clean)
         if numbers:
             for i, num in enumerate(numbers, 1):
                 sets_list.append({'set_number': i, 'reps': int(num)})
@@ -203,43 +244,57 @@ def parse_exercise_line(line: str) -> Optional[Dict]:
     Returns:
         Словарь {'exercise': название, 'sets': количество} или None
     """
+    parsed = _parse_exercise_line_cached(line)
+    if parsed is None:
+        return None
+    
+    exercise_name, sets = parsed
+    return {
+        'exercise': exercise_name,
+        'sets': sets
+    }
+
+
+@lru_cache(maxsize=4096)
+def _parse_exercise_line_cached(line: str) -> Optional[Tuple[str, int]]:
+    """
+    Разбор строки для parse_exercise_line с кэшем по тексту строки.
+    Возвращает неизменяемый кортеж, словарь для вызывающего собирается заново.
+    
+    Returns:
+        Кортеж (название, количество подходов) или None
+    """
     line = line.strip()
     if not line:
         return None
     
     # Убираем эмодзи и специальные символы в начале
-    line = re.sub(r'^[🔹🔸▪️▫️•\-\s]+', '', line).strip()
+    line = line.lstrip(_LEADING_DECOR_CHARS).strip()
     
     # Разделяем название упражнения и описание подходов
     # Ищем разделители: "—", "-", "–" или просто пробел перед числами
-    separators = ['—', '–', '-']
+    # Порядок важен: в "Жим-лежа — 4х10" делим по длинному тире, а не по дефису
     exercise_name = line
     sets_description = ""
     
-    for sep in separators:
-        if sep in line:
-            parts = line.split(sep, 1)
-            if len(parts) == 2:
-                exercise_name = parts[0].strip()
-                sets_description = parts[1].strip()
-                break
+    for sep in _EXERCISE_SEPARATORS:
+        name, found, rest = line.partition(sep)
+        if found:
+            exercise_name = name.strip()
+            sets_description = rest.strip()
+            break
     
-    # Если разделитель не найден, ищем паттерн с числами
-    if not sets_description:
-        # Ищем паттерн: название упражнения, затем числа
-        match = re.match(r'^(.+?)\s+(\d+[хx]\d+|\d+-\d+.*|\d+)', line)
-        if match:
-            exercise_name = match.group(1).strip()
-            sets_description = match.group(2).strip()
+    # Без единой цифры ни один шаблон ниже (и parse_sets_from_exercise) не сработает:
+    # подход один, а ленивый поиск названия с откатами не нужен
+    if not sets_description and not _NUMBER_RE.search(line):
+        return (exercise_name, 1) if exercise_name else None
     
-    # Если все еще нет описания, пробуем найти числа в конце строки
+    # Если разделитель не найден, ищем паттерн: название упражнения, затем числа,
+    # а если его нет - числа в конце строки
     if not sets_description:
-        match = re.search(r'(\d+[хx]\d+|\d+-\d+.*|\d+)\s*$', line)
-        if match:
-            # Находим начало чисел
-            num_start = match.start()
-            exercise_name = line[:num_start].strip()
-            sets_description = match.group(1).strip()
+        split = _split_name_and_sets(line)
+        if split:
+            exercise_name, sets_description = split
     
     # Если название пустое, возвращаем None
     if not exercise_name:
@@ -248,10 +303,7 @@ def parse_exercise_line(line: str) -> Optional[Dict]:
     # Извлекаем количество подходов
     sets = parse_sets_from_exercise(sets_description if sets_description else line)
     
-    return {
-        'exercise': exercise_name,
-        'sets': sets
-    }
+    return exercise_name, sets
 
 
 def parse_program(text: str) -> Dict[str, List[Dict]]:
@@ -273,45 +325,60 @@ def parse_program(text: str) -> Dict[str, List[Dict]]:
     Raises:
         ValueError: Если формат программы некорректный
     """
-    # Используем OrderedDict для гарантии сохранения порядка
-    program = OrderedDict()
+    # Без единой буквы нет ни дня, ни названия упражнения (например, отправлен
+    # вес подхода "60" или "12.5"): сразу отказываем, не разбирая текст построчно
+    if not any(char.isalpha() for char in text):
+        raise ValueError("Не удалось распарсить программу. Проверьте формат.")
     
-    # Разделяем текст на строки
-    lines = text.split('\n')
+    # Одна строка, которая сама является заголовком дня ("ПН: жим 3x10; ВТ: ..."),
+    # построчному разбору ничего не дает - сразу разбираем старый формат
+    stripped = text.strip()
+    if ';' in stripped and len(stripped.splitlines()) == 1 and extract_day_from_text(stripped):
+        program = _parse_legacy(stripped)
+    else:
+        program = _parse_lines(text)
+        # Если программа пустая, пробуем старый формат (разделение по ;)
+        if not program:
+            program = _parse_legacy(text)
+    
+    if not program:
+        raise ValueError("Не удалось распарсить программу. Проверьте формат.")
+    
+    return program
+
+
+def _parse_lines(text: str) -> Dict[str, List[Dict]]:
+    """
+    Построчный разбор программы: заголовки дней и упражнения на отдельных строках.
+    
+    Returns:
+        Словарь {день: [упражнения]}, пустой, если ничего не распознано
+    """
+    # Обычный dict сохраняет порядок вставки дней
+    program = {}
+    
+    # Разделяем текст на непустые строки (splitlines понимает и \r\n, и одиночный \r
+    # из вставки в клиентах Telegram)
+    lines = [line for line in (raw.strip() for raw in text.splitlines()) if line]
     
     current_day = None
-    current_exercises = []
     
     for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        
-        # Пытаемся определить день недели
-        day = extract_day_from_text(line)
+        # Пытаемся определить день недели (строки упражнений отсеиваются
+        # по первому символу, без вызова extract_day_from_text)
+        day = extract_day_from_text(line) if line[0].upper()[0] in _DAY_HEADER_START else None
         if day:
-            # Сохраняем предыдущий день, если есть
-            if current_day and current_exercises:
-                # Создаем копию списка для сохранения порядка
-                program[current_day] = list(current_exercises)
-            
-            # Начинаем новый день
+            # Начинаем новый день (список создается при первом упражнении,
+            # поэтому день без упражнений в программу не попадает)
             current_day = day
-            current_exercises = []
             continue
         
         # Если день еще не определен, пытаемся найти его в начале текста
+        # (extract_day_from_text для этой строки уже вернул None выше)
         if not current_day:
-            # Пробуем найти день в текущей строке
-            day = extract_day_from_text(line)
-            if day:
-                current_day = day
-                current_exercises = []
-                continue
-            
             # Если это первая строка и день не найден, пробуем старый формат
             # "ПН: упражнение1, упражнение2"
-            day_match = re.match(r'^([А-ЯЁ]+)\s*[:—\-]', line, re.IGNORECASE)
+            day_match = _DAY_PREFIX_RE.match(line)
             if day_match:
                 day_short = day_match.group(1).upper()
                 day_full = DAY_MAPPING.get(day_short)
@@ -320,11 +387,13 @@ def parse_program(text: str) -> Dict[str, List[Dict]]:
                     # Извлекаем упражнения из этой строки
                     exercises_text = line[len(day_match.group(0)):].strip()
                     # Разделяем по запятой
-                    exercise_parts = [ex.strip() for ex in exercises_text.split(',') if ex.strip()]
-                    for ex_part in exercise_parts:
+                    for ex_part in exercises_text.split(','):
+                        ex_part = ex_part.strip()
+                        if not ex_part:
+                            continue
                         exercise = parse_exercise_line(ex_part)
                         if exercise:
-                            current_exercises.append(exercise)
+                            program.setdefault(current_day, []).append(exercise)
                     continue
         
         # Парсим строку как упражнение
@@ -333,48 +402,51 @@ def parse_program(text: str) -> Dict[str, List[Dict]]:
             if not current_day:
                 # Если день не определен, используем текущий день недели
                 current_day = get_current_day()
-            current_exercises.append(exercise)
+            # Повторный заголовок того же дня дополняет его, а не затирает
+            program.setdefault(current_day, []).append(exercise)
     
-    # Сохраняем последний день
-    if current_day and current_exercises:
-        # Создаем копию списка для сохранения порядка
-        program[current_day] = list(current_exercises)
+    return program
+
+
+def _parse_legacy(text: str) -> Dict[str, List[Dict]]:
+    """
+    Разбор старого формата "ПН: упражнение1, упражнение2; ВТ: ...".
     
-    # Если программа пустая, пробуем старый формат (разделение по ;)
-    if not program:
-        day_blocks = re.split(r'[;]', text)
+    Returns:
+        Словарь {день: [упражнения]}, пустой, если ничего не распознано
+    """
+    program = {}
+    day_blocks = text.split(';')
+    
+    for block in day_blocks:
+        block = block.strip()
+        if not block:
+            continue
         
-        for block in day_blocks:
-            block = block.strip()
-            if not block:
-                continue
-            
-            # Ищем день недели в начале блока
-            day_match = re.match(r'^([А-ЯЁ]+)\s*[:—\-]', block, re.IGNORECASE)
-            if not day_match:
-                continue
-            
-            day_short = day_match.group(1).upper()
-            day_full = DAY_MAPPING.get(day_short)
-            
-            if not day_full:
+        # Ищем день недели в начале блока
+        day_match = _DAY_PREFIX_RE.match(block)
+        if not day_match:
+            continue
+        
+        day_short = day_match.group(1).upper()
+        day_full = DAY_MAPPING.get(day_short)
+        
+        if not day_full:
+            continue
+        
+        # Извлекаем упражнения из блока
+        exercises_text = block[len(day_match.group(0)):].strip()
+        
+        program[day_full] = []
+        
+        # Разделяем упражнения по запятой
+        for exercise_text in exercises_text.split(','):
+            exercise_text = exercise_text.strip()
+            if not exercise_text:
                 continue
-            
-            # Извлекаем упражнения из блока
-            exercises_text = block[len(day_match.group(0)):].strip()
-            
-            # Разделяем упражнения по запятой
-            exercises = [ex.strip() for ex in exercises_text.split(',') if ex.strip()]
-            
-            program[day_full] = []
-            
-            for exercise_text in exercises:
-                exercise = parse_exercise_line(exercise_text)
-                if exercise:
-                    program[day_full].append(exercise)
-    
-    if not program:
-        raise ValueError("Не удалось распарсить программу. Проверьте формат.")
+            exercise = parse_exercise_line(exercise_text)
+            if exercise:
+                program[day_full].append(exercise)
     
     return program
 
@@ -386,12 +458,4 @@ def get_current_day() -> str:
     Returns:
         Название дня недели (например, "Понедельник")
     """
-    from datetime import datetime
-    
-    days = [
-        'Понедельник', 'Вторник', 'Среда', 'Четверг',
-        'Пятница', 'Суббота', 'Воскресенье'
-    ]
-    
-    today = datetime.now().weekday()  # 0 = понедельник, 6 = воскресенье
-    return days[today]
+    return _WEEKDAYS[datetime.now().weekday()]
@@ -1,8 +1,13 @@
 """
 Вспомогательные функции для бота.
 """
+import re
 from typing import Dict, List
 
+# Сообщение с весом подхода: целое или дробное число (через точку или запятую).
+# Компилируется один раз и передается в фильтры F.text.regexp обработчиков
+WEIGHT_RE = re.compile(r'^\d+([.,]\d+)?$')
+
 
 def format_program_text(program: Dict[str, List[Dict]]) -> str:
     """
@@ -37,9 +42,9 @@ def format_training_exercises(day: str, exercises: List[Dict]) -> str:
     Returns:
         Отформатированная строка
     """
-    text = f"🏋️ Тренировка на {day}:\n\n"
+    lines = [f"🏋️ Тренировка на {day}:", ""]
     for i, ex in enumerate(exercises, 1):
-        text += f"{i}. {ex['exercise']} — {ex['sets']} подходов\n"
+        lines.append(f"{i}. {ex['exercise']} — {ex['sets']} подходов")
     
-    return text
+    return "\n".join(lines) + "\n"
 
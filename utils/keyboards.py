@@ -2,8 +2,30 @@
 Модуль с клавиатурами для бота.
 Содержит Reply и Inline клавиатуры для взаимодействия с пользователем.
 """
-from typing import List, Dict
+from functools import lru_cache
+from typing import List, Dict, Tuple
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from database import get_program_day_counts
+
+
+@lru_cache(maxsize=256)
+def _build_inline_keyboard(rows: Tuple[Tuple[str, str], ...]) -> InlineKeyboardMarkup:
+    """
+    Строит inline клавиатуру по одной кнопке в строке.
+    Ключ кэша - сами тексты и callback_data кнопок, поэтому повторный показ
+    того же списка программ/тренировок не создает клавиатуру заново,
+    а после изменения списка кэш не может отдать устаревшие кнопки.
+    
+    Args:
+        rows: Кортеж пар (текст кнопки, callback_data)
+    
+    Returns:
+        InlineKeyboardMarkup
+    """
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=text, callback_data=callback_data)]
+        for text, callback_data in rows
+    ])
 
 
 def get_main_keyboard(has_programs: bool = False) -> ReplyKeyboardMarkup:
@@ -19,9 +41,11 @@ def get_main_keyboard(has_programs: bool = False) -> ReplyKeyboardMarkup:
     return get_restart_keyboard(has_programs)
 
 
+@lru_cache(maxsize=None)
 def get_save_program_keyboard() -> InlineKeyboardMarkup:
     """
     Создает inline клавиатуру для сохранения программы.
+    Клавиатура постоянная, поэтому строится один раз.
     
     Returns:
         InlineKeyboardMarkup с кнопкой "Сохранить программу"
@@ -34,9 +58,11 @@ def get_save_program_keyboard() -> InlineKeyboardMarkup:
     return keyboard
 
 
+@lru_cache(maxsize=None)
 def get_training_control_keyboard() -> InlineKeyboardMarkup:
     """
     Создает inline клавиатуру для управления тренировкой.
+    Клавиатура постоянная, поэтому строится один раз.
     
     Returns:
         InlineKeyboardMarkup с кнопками "Закончить тренировку"
@@ -49,9 +75,11 @@ def get_training_control_keyboard() -> InlineKeyboardMarkup:
     return keyboard
 
 
+@lru_cache(maxsize=None)
 def get_confirm_keyboard() -> InlineKeyboardMarkup:
     """
     Создает inline клавиатуру для подтверждения веса.
+    Клавиатура постоянная, поэтому строится один раз.
     
     Returns:
         InlineKeyboardMarkup с кнопками "Подтвердить" и "Изменить"
@@ -67,9 +95,11 @@ def get_confirm_keyboard() -> InlineKeyboardMarkup:
     return keyboard
 
 
+@lru_cache(maxsize=None)
 def get_mode_selection_keyboard() -> InlineKeyboardMarkup:
     """
     Создает inline клавиатуру для выбора режима загрузки программы.
+    Клавиатура постоянная, поэтому строится один раз.
     
     Returns:
         InlineKeyboardMarkup с кнопками "Загрузить программу" и "Добавить программу вручную"
@@ -83,9 +113,11 @@ def get_mode_selection_keyboard() -> InlineKeyboardMarkup:
     return keyboard
 
 
+@lru_cache(maxsize=None)
 def get_workout_count_keyboard_with_cancel() -> InlineKeyboardMarkup:
     """
     Создает inline клавиатуру для выбора количества тренировок с кнопкой отмены.
+    Клавиатура постоянная, поэтому строится один раз.
     
     Returns:
         InlineKeyboardMarkup с кнопками от 1 до 7 тренировок и кнопкой отмены
@@ -109,6 +141,19 @@ def get_workout_count_keyboard_with_cancel() -> InlineKeyboardMarkup:
     return keyboard
 
 
+def _uploaded_days_counts(programs: List[Dict], user_id: int = None) -> Dict[int, int]:
+    """
+    Количество дней в uploaded программах списка (без user_id не считается).
+    
+    Returns:
+        Словарь {program_id: количество дней}
+    """
+    if not user_id:
+        return {}
+    uploaded_ids = [program['id'] for program in programs if program['program_type'] != 'manual']
+    return get_program_day_counts(user_id, uploaded_ids) if uploaded_ids else {}
+
+
 def get_program_selection_keyboard(programs: List[Dict], user_id: int = None) -> InlineKeyboardMarkup:
     """
     Создает inline клавиатуру для выбора программы тренировок.
@@ -120,27 +165,22 @@ def get_program_selection_keyboard(programs: List[Dict], user_id: int = None) ->
     Returns:
         InlineKeyboardMarkup с кнопками программ
     """
+    # Для uploaded программ количество дней считаем одним запросом на все программы
+    days_counts = _uploaded_days_counts(programs, user_id)
+    
     buttons = []
     for program in programs:
         if program['program_type'] == 'manual':
             text = f"{program['program_name']} - {program['workout_count']} дней"
         else:
-            # Для uploaded программ считаем количество дней
             if user_id:
-                from database import get_program_by_id
-                program_data = get_program_by_id(user_id, program['id'])
-                days_count = len(program_data) if program_data else 0
-                text = f"{program['program_name']} - {days_count} дней"
+                text = f"{program['program_name']} - {days_counts.get(program['id'], 0)} дней"
             else:
                 text = program['program_name']
         
-        buttons.append([InlineKeyboardButton(
-            text=text,
-            callback_data=f"select_program_{program['id']}"
-        )])
+        buttons.append((text, f"select_program_{program['id']}"))
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    return keyboard
+    return _build_inline_keyboard(tuple(buttons))
 
 
 def get_delete_program_keyboard(programs: List[Dict], user_id: int = None) -> InlineKeyboardMarkup:
@@ -154,32 +194,29 @@ def get_delete_program_keyboard(programs: List[Dict], user_id: int = None) -> In
     Returns:
         InlineKeyboardMarkup с кнопками программ для удаления
     """
+    days_counts = _uploaded_days_counts(programs, user_id)
+    
     buttons = []
     for program in programs:
         if program['program_type'] == 'manual':
             text = f"🗑️ {program['program_name']} - {program['workout_count']} дней"
         else:
             if user_id:
-                from database import get_program_by_id
-                program_data = get_program_by_id(user_id, program['id'])
-                days_count = len(program_data) if program_data else 0
-                text = f"🗑️ {program['program_name']} - {days_count} дней"
+                text = f"🗑️ {program['program_name']} - {days_counts.get(program['id'], 0)} дней"
             else:
                 text = f"🗑️ {program['program_name']}"
         
-        buttons.append([InlineKeyboardButton(
-            text=text,
-            callback_data=f"delete_program_{program['id']}"
-        )])
+        buttons.append((text, f"delete_program_{program['id']}"))
     
-    buttons.append([InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_delete")])
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    return keyboard
+    buttons.append(("❌ Отмена", "cancel_delete"))
+    return _build_inline_keyboard(tuple(buttons))
 
 
+@lru_cache(maxsize=None)
 def get_persistent_menu_keyboard() -> ReplyKeyboardMarkup:
     """
     Создает постоянное меню с основными кнопками.
+    Клавиатура постоянная, поэтому строится один раз.
     
     Returns:
         ReplyKeyboardMarkup с кнопками "Начать тренировку", "Удалить тренировку", "Перезапустить бота"
@@ -197,9 +234,11 @@ def get_persistent_menu_keyboard() -> ReplyKeyboardMarkup:
     return keyboard
 
 
+@lru_cache(maxsize=None)
 def get_restart_keyboard(has_programs: bool = False) -> ReplyKeyboardMarkup:
     """
     Создает клавиатуру для перезапуска бота с опциональной кнопкой удаления программ.
+    Вариантов всего два (с кнопкой удаления и без), каждый строится один раз.
     
     Args:
         has_programs: Есть ли у пользователя программы
@@ -224,9 +263,11 @@ def get_restart_keyboard(has_programs: bool = False) -> ReplyKeyboardMarkup:
     return keyboard
 
 
+@lru_cache(maxsize=None)
 def get_workout_count_keyboard() -> InlineKeyboardMarkup:
     """
     Создает inline клавиатуру для выбора количества тренировок в неделю.
+    Клавиатура постоянная, поэтому строится один раз.
     
     Returns:
         InlineKeyboardMarkup с кнопками от 1 до 7 тренировок
@@ -249,31 +290,47 @@ def get_workout_count_keyboard() -> InlineKeyboardMarkup:
     return keyboard
 
 
+@lru_cache(maxsize=8)
+def get_create_workouts_keyboard(count: int) -> InlineKeyboardMarkup:
+    """
+    Создает inline клавиатуру с кнопками настройки тренировок от 1 до count.
+    Количество выбирается из 1-7, поэтому каждая клавиатура строится один раз.
+    
+    Args:
+        count: Количество тренировок
+    
+    Returns:
+        InlineKeyboardMarkup с кнопками "Тренировка N"
+    """
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"Тренировка {i}", callback_data=f"create_workout_{i}")]
+        for i in range(1, count + 1)
+    ])
+
+
 def get_workout_buttons_keyboard(workouts: list) -> InlineKeyboardMarkup:
     """
     Создает inline клавиатуру с кнопками тренировок.
     
     Args:
-        workouts: Список тренировок [{'workout_number': 1, 'workout_name': 'Ноги'}, ...]
+        workouts: Список тренировок [{'workout_number': 1, 'workout_name': 'Ноги'}, ...] (словари или sqlite3.Row)
     
     Returns:
         InlineKeyboardMarkup с кнопками тренировок
     """
-    buttons = []
-    for workout in workouts:
-        text = f"Тренировка {workout['workout_number']} - {workout['workout_name']}"
-        buttons.append([InlineKeyboardButton(
-            text=text,
-            callback_data=f"select_workout_{workout['workout_number']}"
-        )])
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    return keyboard
+    buttons = tuple(
+        (f"Тренировка {workout['workout_number']} - {workout['workout_name']}",
+         f"select_workout_{workout['workout_number']}")
+        for workout in workouts
+    )
+    return _build_inline_keyboard(buttons)
 
 
+@lru_cache(maxsize=None)
 def get_confirm_workout_keyboard() -> InlineKeyboardMarkup:
     """
     Создает inline клавиатуру для подтверждения тренировки.
+    Клавиатура постоянная, поэтому строится один раз.
     
     Returns:
         InlineKeyboardMarkup с кнопками "✅ Верно" и "❌ Неверно"
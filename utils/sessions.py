@@ -0,0 +1,61 @@
+"""
+Хранилище сессий пользователей в памяти.
+Сессии брошенных сценариев (не подтвердил тренировку, не завершил подходы)
+со временем удаляются сами, поэтому память не растет бесконечно.
+"""
+import time
+
+
+class SessionStore(dict):
+    """
+    Словарь {user_id: сессия} с ограничением по времени жизни и размеру.
+    
+    Время жизни отсчитывается от последнего обращения к сессии (запись, [] или get),
+    так что активная тренировка не истекает посреди подходов. Устаревшие сессии
+    удаляются только при добавлении новой: проверка `user_id in store` и
+    последующее чтение `store[user_id]` всегда видят одно и то же.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 100_000):
+        """
+        Args:
+            ttl: Время жизни сессии без обращений, секунд
+            maxsize: Максимальное число сессий (при превышении удаляется самая давняя)
+        """
+        super().__init__()
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._touched = {}
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._expire()
+        super().__setitem__(key, value)
+        self._touched[key] = time.monotonic()
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self._touched[key] = time.monotonic()
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._touched.pop(key, None)
+
+    def pop(self, key, *default):
+        self._touched.pop(key, None)
+        return super().pop(key, *default)
+
+    def _expire(self):
+        """Удаляет истекшие сессии и, если места нет, самую давнюю."""
+        deadline = time.monotonic() - self.ttl
+        for key in [key for key, touched in self._touched.items() if touched < deadline]:
+            del self[key]
+        
+        if len(self) >= self.maxsize:
+            del self[min(self._touched, key=self._touched.get)]